@@ -1,6 +1,11 @@
 import os
 import yaml
 import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+# The libyaml based loader is much faster, but only available if PyYAML is built with libyaml
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 class Config:
     """
@@ -24,6 +29,10 @@ class Config:
             # Initialize (the normal __init__() but only called once)
             cls._instances[path]._path = path
             cls._instances[path]._data = None
+            # Modification time of the file when it was loaded
+            cls._instances[path]._mtime = None
+            # Modification time of the file when it last failed to reload, to warn only once per change
+            cls._instances[path]._failed_mtime = None
             cls._instances[path]._lock = asyncio.Lock()
         return cls._instances.get(path)
 
@@ -33,12 +42,48 @@ class Config:
 
     async def load(self):
         async with self._lock:
+            # Taken before reading, so changes made while reading are loaded next time
+            mtime = self._get_mtime()
             try:
                 with open(self._path, 'r') as yaml_file:
-                    self._data = yaml.safe_load(yaml_file) or {}
+                    self._data = yaml.load(yaml_file, Loader=YamlLoader) or {}
             except FileNotFoundError as e:
                 # Create a new blank config
                 self._data = {}
+            self._mtime = mtime
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self._path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    async def reload_if_changed(self) -> bool:
+        """
+        Reload the config if the file was modified since it was loaded.
+        If the new file cannot be read or parsed (e.g. a typo, or it is being written), the loaded config is kept
+        and the file is read again when it is modified.
+
+        Return: whether the config was reloaded.
+        """
+        if self._data is None:
+            await self.load()
+            return True
+        mtime = self._get_mtime()
+        if mtime == self._mtime or mtime == self._failed_mtime:
+            return False
+        try:
+            with open(self._path, 'r') as yaml_file:
+                data = yaml.load(yaml_file, Loader=YamlLoader)
+            if not isinstance(data, dict):
+                raise ValueError('the file does not contain a mapping')
+        except (OSError, ValueError, yaml.YAMLError) as e:
+            self._failed_mtime = mtime
+            logger.warning(f'Failed to reload config {self._path}, keeping the loaded config: {e}')
+            return False
+        async with self._lock:
+            self._data, self._mtime = data, mtime
+        return True
 
     async def get(self, *keys, default=None):
         async with self._lock:
@@ -59,9 +104,10 @@ class Config:
         This method is NOT coroutine safe.
         """
         if self._data is None:
+            self._mtime = self._get_mtime()
             try:
                 with open(self._path, 'r') as yaml_file:
-                    self._data = yaml.safe_load(yaml_file) or {}
+                    self._data = yaml.load(yaml_file, Loader=YamlLoader) or {}
             except FileNotFoundError as e:
                 self._data = {}
         current_dict = self._data
@@ -83,6 +129,8 @@ class Config:
             current_dict[keys[-1]] = value
             with open(self._path, 'w') as yaml_file:
                 yaml.dump(self._data, yaml_file)
+            # Written data is already loaded
+            self._mtime = self._get_mtime()
 
     async def delete(self, *keys):
         async with self._lock:
@@ -97,6 +145,7 @@ class Config:
                 del current_dict[keys[-1]]
                 with open(self._path, 'w') as yaml_file:
                     yaml.dump(self._data, yaml_file)
+                self._mtime = self._get_mtime()
 
 async def main():
     # Run some tests here
@@ -1,12 +1,37 @@
+import asyncio
 import logging
 import os
+import re
+import time
+from bson import ObjectId
+from collections import OrderedDict
+from itertools import groupby
 from .config import Config
 from datetime import datetime, timedelta
 from motor.motor_asyncio import AsyncIOMotorClient
-from .utils import get_bridge_map
+from pymongo import IndexModel, InsertOne, UpdateMany, UpdateOne, WriteConcern
+from pymongo.errors import PyMongoError
+from .utils import get_outbound_groups_nowait, utcnow
 
 config = Config('bridge.yaml')
 logger = logging.getLogger(__name__)
+# Buffered writes are sent when there are this many of them, or after WRITE_FLUSH_INTERVAL seconds
+WRITE_BATCH_SIZE = 50
+WRITE_FLUSH_INTERVAL = 0.2
+# Number of recent (group, message_id) pairs whose document _id is remembered
+ID_CACHE_SIZE = 50000
+# Seconds to reuse the active groups of a user, so bursts of part/quit/nick events query once
+ACTIVE_GROUPS_TTL = 30
+# Fields of a message document needed by edit/delete handlers, relays and filters
+MESSAGE_PROJECTION = {
+    '_id': 1,
+    'deleted': 1,
+    'bridge_messages': 1,
+    'text': 1,
+    'files': 1,
+    'from_nick': 1,
+    'fwd_from': 1,
+}
 try:
     logger.setLevel(config.get_nowait('Logging', 'level', default='INFO'))
 except ValueError:
@@ -31,9 +56,118 @@ class MongoDB:
     def __init__(self):
         if not self.client:
             # Initialize MongoDB client
-            self.client = AsyncIOMotorClient(config.get_nowait('Mongo', 'uri'))
+            self.client = AsyncIOMotorClient(
+                config.get_nowait('Mongo', 'uri'),
+                # Listeners, workers and the poller share one pool; keep some connections
+                # open so bursts of messages do not have to reconnect
+                maxPoolSize=config.get_nowait('Mongo', 'max_pool_size', default=50),
+                minPoolSize=config.get_nowait('Mongo', 'min_pool_size', default=5),
+                maxIdleTimeMS=300000,
+                # Fail fast instead of blocking handlers for the default 30 seconds when MongoDB is down
+                serverSelectionTimeoutMS=config.get_nowait('Mongo', 'server_selection_timeout_ms', default=3000),
+                # Needs the zstandard package
+                compressors='zstd',
+                retryWrites=True,
+                # Bridged messages can be recovered from the platforms, so do not wait for journal
+                w=1,
+                journal=config.get_nowait('Mongo', 'journal', default=False),
+            )
             self.db = self.client[config.get_nowait('Mongo', 'database_name')]
             self.collection = self.db[config.get_nowait('Mongo', 'collection_name')]
+            # Optionally send inserts without waiting for acknowledgement, at the risk of silently losing messages
+            if config.get_nowait('Mongo', 'unacknowledged_inserts', default=False):
+                self._insert_collection = self.collection.with_options(write_concern=WriteConcern(w=0))
+            else:
+                self._insert_collection = self.collection
+            # Pending inserts and updates, written in bulk by flusher()
+            self._write_buffer: 'list[InsertOne | UpdateOne | UpdateMany]' = []
+            self._flush_event = asyncio.Event()
+            # Held while a batch is being written, so flush() returns only after earlier writes are done
+            self._flush_lock = asyncio.Lock()
+            # (group, message_id) -> _id of recently inserted messages, to look them up by primary key
+            self._id_cache: 'OrderedDict[tuple[str, int], ObjectId]' = OrderedDict()
+            # user_id -> platform -> (expiry time, groups), see get_active_groups_on_platform()
+            self._active_groups_cache: 'dict[str | int, dict[str, tuple[float, list[str]]]]' = dict()
+
+    async def create_indexes(self):
+        """
+        Create indexes used by hot queries. Should be called once at startup;
+        MongoDB ignores indexes that already exist.
+        """
+        await self.collection.create_indexes([
+            # Multikey index to look up a message by any of its bridged copies, skipping deleted ones in the index
+            IndexModel([('bridge_messages.group', 1), ('bridge_messages.message_id', 1), ('deleted', 1)]),
+            # Recent messages of a group, used by the telegram deleted poller
+            IndexModel([('bridge_messages.group', 1), ('_id', -1)]),
+            # Recent messages of a user, used to find groups where the user is active
+            IndexModel([('from_user_id', 1), ('created_at', -1)]),
+            # Only deleted messages are indexed, which are the minority
+            IndexModel([('deleted', 1)], partialFilterExpression={'deleted': True}),
+        ])
+
+    def _write(self, request: 'InsertOne | UpdateOne | UpdateMany'):
+        """
+        Queue a write request to be sent by flusher().
+        """
+        self._write_buffer.append(request)
+        if len(self._write_buffer) >= WRITE_BATCH_SIZE:
+            self._flush_event.set()
+
+    def insert_message(self, msg_doc: dict):
+        """
+        Queue a message document to be inserted by flusher().
+        """
+        # Generate _id here instead of in database, so it can be cached before the insert
+        msg_doc.setdefault('_id', ObjectId())
+        for bridge_message in msg_doc.get('bridge_messages', []):
+            if bridge_message.get('message_id') is None:
+                continue
+            self._id_cache[(bridge_message.get('group'), bridge_message.get('message_id'))] = msg_doc['_id']
+        while len(self._id_cache) > ID_CACHE_SIZE:
+            self._id_cache.popitem(last=False)
+        # The user may be active in a new group now
+        self._active_groups_cache.pop(msg_doc.get('from_user_id'), None)
+        self._write(InsertOne(msg_doc))
+
+    def update_message(self, _id, update: dict):
+        """
+        Queue an update of the message document with given _id to be written by flusher().
+        """
+        self._write(UpdateOne({'_id': _id}, update))
+
+    async def flush(self):
+        """
+        Write all pending requests to database in one request.
+        Called by flusher(), and before queries which may need pending messages.
+        """
+        async with self._flush_lock:
+            if not self._write_buffer:
+                return
+            requests, self._write_buffer = self._write_buffer, []
+            if self._insert_collection is self.collection:
+                batches = [(self.collection, requests)]
+            else:
+                # Consecutive inserts and updates are written separately, in order
+                batches = [(self._insert_collection if is_insert else self.collection, list(group))
+                           for is_insert, group in groupby(requests, key=lambda request: isinstance(request, InsertOne))]
+            for collection, batch in batches:
+                try:
+                    # Ordered, since an update may follow the insert or an earlier update of the same message
+                    await collection.bulk_write(batch, ordered=True)
+                except PyMongoError as e:
+                    logger.warning(f'Failed to write {len(batch)} message changes: {e}')
+
+    async def flusher(self):
+        """
+        Flush pending writes periodically, or as soon as there are enough of them.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=WRITE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush()
 
     async def find_bridged_messages_to_update(self, group: str, message_id: int):
         """
@@ -50,49 +184,95 @@ class MongoDB:
         but will update the bridge_messages to {A, C} & {D} == {}, where {D} comes from Bridge config,
         since C's updates should only propagate to group D.
         """
-        message = await self.collection.find_one({
+        if not get_outbound_groups_nowait(group):
+            # Nothing to update
+            return
+        # The message may still be waiting to be inserted
+        await self.flush()
+        _id = self._id_cache.get((group, message_id))
+        if _id:
+            # Recent messages are found by primary key
+            query = {'_id': _id}
+        else:
+            query = {
+                'bridge_messages': {
+                    '$elemMatch': {
+                        'group': group,
+                        'message_id': message_id,
+                    }
+                },
+            }
+        # Deleted messages can no longer be edited, deleted or replied
+        # Every document is inserted with 'deleted': False, and equality can be matched in the index
+        query['deleted'] = False
+        message = await self.collection.find_one(query, projection=MESSAGE_PROJECTION)
+        if not message:
+            return
+        return await self._filter_outbound_groups(message, group)
+
+    async def find_bridged_messages_to_update_many(self, group: str, message_ids: list[int]) -> list[dict]:
+        """
+        Same as find_bridged_messages_to_update(), but for many message ids in the same group at once.
+
+        Returns a list of message documents found.
+        """
+        if not message_ids or not get_outbound_groups_nowait(group):
+            return []
+        await self.flush()
+        messages = await self.collection.find({
             'bridge_messages': {
                 '$elemMatch': {
                     'group': group,
-                    'message_id': message_id,
+                    'message_id': {'$in': list(message_ids)},
                 }
-            }
-        })
-        if not message:
-            return
-        connected_groups = {m.get('group') for m in message.get('bridge_messages', {})}
-        # Only update outbound connected groups
-        outbound_groups = set((await get_bridge_map()).get(group, set()))
-        groups_to_update = outbound_groups & connected_groups
-        message['bridge_messages'] = [m for m in message.get('bridge_messages', {}) if m.get('group') in groups_to_update]
+            },
+            'deleted': False,
+        }, projection=MESSAGE_PROJECTION).to_list(None)
+        return [await self._filter_outbound_groups(message, group) for message in messages]
+
+    async def _filter_outbound_groups(self, message: dict, group: str) -> dict:
+        """
+        Filter the 'bridge_messages' field of a message document so it only includes
+        outbound connected groups of the given group.
+        """
+        # Only update outbound connected groups. Intersecting with groups of the message is implied by the filter
+        outbound_groups = get_outbound_groups_nowait(group)
+        message['bridge_messages'] = [m for m in message.get('bridge_messages', {}) if m.get('group') in outbound_groups]
         return message
 
-    async def delete_message_record(self, msg_doc):
+    async def delete_message_record(self, msg_doc, deleted_at: datetime=None):
         """
         Delete all media files contained in the given message, and delete the record from db.
         Note that currently the method does not actually remove a record,
         it just mark the record as deleted for possible future references.
         """
-        if not msg_doc or msg_doc.get('deleted') or not msg_doc.get('bridge_messages'):
+        await self.delete_message_records([msg_doc], deleted_at)
+
+    async def delete_message_records(self, msg_docs: list[dict], deleted_at: datetime=None):
+        """
+        Same as delete_message_record(), but mark all given messages as deleted in one query.
+
+        deleted_at: time of deletion, defaults to now. Pass the same value when deleting in a loop.
+        """
+        msg_docs = [msg_doc for msg_doc in msg_docs
+                    if msg_doc and not msg_doc.get('deleted') and msg_doc.get('bridge_messages')]
+        if not msg_docs:
             return
 
-        # Delete all files contained in the message
-        for file in msg_doc.get('files', []):
-            if not file: continue
-            if file.get('path'):
-                logger.info(f'Deleting local file {file.get("path")}')
-                try:
-                    os.remove(file.get('path'))
-                except OSError:
-                    pass
+        # Delete all files contained in the messages in threads, so disk I/O does not block the event loop
+        paths = [file.get('path') for msg_doc in msg_docs for file in msg_doc.get('files', []) if file and file.get('path')]
+        if paths:
+            logger.info('Deleting local files %s', paths)
+            # Errors such as files already removed are ignored
+            await asyncio.gather(*[asyncio.to_thread(os.remove, path) for path in paths], return_exceptions=True)
 
         # Mark as deleted internally
-        await self.collection.update_one({'_id': msg_doc.get('_id')}, {
+        self._write(UpdateMany({'_id': {'$in': [msg_doc.get('_id') for msg_doc in msg_docs]}}, {
             '$set': {
                 'deleted': True,
-                'deleted_at': datetime.utcnow(),
+                'deleted_at': deleted_at or utcnow(),
             }
-        })
+        }))
 
     async def get_active_groups_on_platform(self, user_id, platform='irc') -> list[str]:
         """
@@ -100,22 +280,38 @@ class MongoDB:
 
         Currently only active IRC users are tracked to display a system message after they quit.
 
+        Results are cached for ACTIVE_GROUPS_TTL seconds, until the user sends another message.
+
         TODO: make the duration configurable
         """
+        now = time.monotonic()
+        cached = self._active_groups_cache.get(user_id, {}).get(platform)
+        if cached and cached[0] > now:
+            return cached[1]
         timeout = 600  # in seconds
-        deadline = datetime.utcnow() - timedelta(seconds=timeout)
-        # TODO: Find the most recent channels
-        ret = set()
-        messages = self.collection.find({
-            'from_user_id': user_id,
-            # Exclude system messages like join/quit, change nick, ...
-            'system': False,
-            'created_at': {
-                '$gte': deadline,
-            },
-        })
-        # For each message found, add corresponding groups on given platform
-        for message in await messages.to_list(length=10):
-            ret |= {bm.get('group') for bm in message.get('bridge_messages', []) if bm.get('group', '').startswith(platform)}
-
-        return list(ret)
+        deadline = utcnow() - timedelta(seconds=timeout)
+        # The last messages may still be waiting to be inserted
+        await self.flush()
+        # Let the server collect distinct groups on given platform of all recent messages
+        groups = self.collection.aggregate([
+            {'$match': {
+                'from_user_id': user_id,
+                # Exclude system messages like join/quit, change nick, ...
+                'system': False,
+                'created_at': {
+                    '$gte': deadline,
+                },
+            }},
+            {'$unwind': '$bridge_messages'},
+            {'$match': {'bridge_messages.group': {'$regex': f'^{re.escape(platform)}/'}}},
+            {'$group': {'_id': '$bridge_messages.group'}},
+        ])
+        ret = [group['_id'] async for group in groups]
+        if len(self._active_groups_cache) > ID_CACHE_SIZE:
+            # Drop users whose results have all expired
+            self._active_groups_cache = {
+                user: platforms for user, platforms in self._active_groups_cache.items()
+                if any(expiry > now for expiry, _ in platforms.values())
+            }
+        self._active_groups_cache.setdefault(user_id, {})[platform] = (now + ACTIVE_GROUPS_TTL, ret)
+        return ret
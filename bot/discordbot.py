@@ -1,10 +1,14 @@
+import asyncio
 import discord
+import io
 import logging
+import os
 from . import utils
 from .config import Config
 from .database import MongoDB
 from .im import MessagingPlatform
 from .message import File, Message
+from collections import defaultdict
 from discord import app_commands
 from discord.ext.commands import is_owner, Bot, Context
 
@@ -18,6 +22,10 @@ except ValueError:
 db = MongoDB()
 msg_collection = db.collection
 message_queue = utils.message_queue
+# Read once, so downloads do not go through the config lock
+FILES_PATH = config.get_nowait('Files', 'path', default='')
+# Limit concurrent attachment downloads to avoid hitting rate limits of the CDN
+download_semaphore = asyncio.Semaphore(4)
 
 class Discord(MessagingPlatform):
     """
@@ -30,8 +38,23 @@ class Discord(MessagingPlatform):
             intents.message_content = True
             #self.bot = discord.Client(intents=intents)
             self.bot = Bot(command_prefix='!', intents=intents)
+            # Channel id -> channel object of bridged channels, see get_channel()
+            self.channels: 'dict[int, discord.abc.GuildChannel]' = {}
             self.register_listeners()
 
+    def get_channel(self, channel_id: int):
+        """
+        Get a channel by id, cached so the worker does not look it up for every message.
+
+        Return: the channel object, or None if not found.
+        """
+        channel = self.channels.get(channel_id)
+        if not channel:
+            channel = self.bot.get_channel(channel_id)
+            if channel:
+                self.channels[channel_id] = channel
+        return channel
+
     async def download_media(self, message: discord.Message) -> list[File]:
         """
         Helper method to download media from a message and save the media type.
@@ -39,33 +62,47 @@ class Discord(MessagingPlatform):
         Return: list of File contains type and path of the media.
         Filenames will be generated randomly to avoid duplicate names.
         """
+        # Download all attachments concurrently, keeping their order
+        results = await asyncio.gather(*[self.download_attachment(message, attachment) for attachment in message.attachments],
+                                       return_exceptions=True)
         ret = []
-        for attachment in message.attachments:
-            # Content type is like 'image/png' so we can infer file extension from it
-            if attachment.content_type:
-                media_type, ext = attachment.content_type.split('/', 1)
-            else:
-                media_type, ext = '', ''
-            directory = await config.get('Files', 'path', default='')
-            path = File.generate_name(directory, ext)
-            try:
-                await attachment.save(path)
-            except (discord.HTTPException, discord.NotFound) as e:
-                logger.warning(f'Downloading discord attachment {attachment} from {message} failed: {e}')
-                path = ''
-            file = File(media_type, path, ext, filename=attachment.filename,
-                        size=attachment.size, height=attachment.height, width=attachment.width,
-                        duration=attachment.duration, description=attachment.description,
-                        is_spoiler=attachment.is_spoiler(), is_voice=attachment.is_voice_message())
-            logger.info(f'Downloaded one Discord file: {file}, path: {path}, is_empty: {file.is_empty()}, metadata: {file.metadata}')
+        for attachment, file in zip(message.attachments, results):
+            if isinstance(file, Exception):
+                logger.warning(f'Downloading discord attachment {attachment} from {message} failed: {file}')
+                continue
             if not file.is_empty():
                 # Only add non-empty files (i.e. download succeeded)
                 ret.append(file)
-                if not (await file.upload()):
-                    logger.info(f'Warning: failed to upload Discord file at {path}')
-        logger.info(f'Downloaded Discord files: {ret}')
+        logger.info('Downloaded Discord files: %s', ret)
         return ret
 
+    async def download_attachment(self, message: discord.Message, attachment: discord.Attachment) -> File:
+        """
+        Download one attachment of a message, see download_media().
+        """
+        # Content type is like 'image/png' so we can infer file extension from it
+        if attachment.content_type:
+            media_type, ext = attachment.content_type.split('/', 1)
+        else:
+            media_type, ext = '', ''
+        path = File.generate_name(FILES_PATH, ext)
+        try:
+            async with download_semaphore:
+                await attachment.save(path)
+        except (discord.HTTPException, discord.NotFound) as e:
+            logger.warning(f'Downloading discord attachment {attachment} from {message} failed: {e}')
+            path = ''
+        file = File(media_type, path, ext, filename=attachment.filename,
+                    size=attachment.size, height=attachment.height, width=attachment.width,
+                    duration=attachment.duration, description=attachment.description,
+                    is_spoiler=attachment.is_spoiler(), is_voice=attachment.is_voice_message(),
+                    # To tell whether the attachment is changed when the message is edited
+                    media_id=attachment.id)
+        logger.info('Downloaded one Discord file: %s, path: %s, metadata: %s', file, path, file.metadata)
+        if not file.is_empty() and not (await file.upload()):
+            logger.info('Warning: failed to upload Discord file at %s', path)
+        return file
+
     def register_listeners(self):
         bot = self.bot
 
@@ -74,43 +111,47 @@ class Discord(MessagingPlatform):
             synced = await bot.tree.sync()
             logging.info(f'Discord: we have logged in as {bot.user}, {len(synced)} commands synced')
 
+        @bot.event
+        async def on_guild_channel_delete(channel):
+            self.channels.pop(channel.id, None)
+
         @bot.tree.command(description="列出 IRC 频道所有用户，或查看目标是否在频道中")
         @app_commands.describe(target="要查看是否在线的昵称，可选")
         async def ircnames(interaction: discord.Interaction, target: str=''):
-            if ('discord/' + str(interaction.channel.id)) not in (await utils.get_bridge_map()):
+            if interaction.channel.id not in utils.get_bridge_ids_nowait('discord'):
                 return
-            logger.info(f'Discord {interaction.channel.id} incoming /ircnames: ' + str(interaction.message))
+            logger.debug('Discord %s incoming /ircnames: %s', interaction.channel.id, interaction.message)
             await message_queue.put({
                 'action': 'ircnames',
                 'target': target,
                 'event': interaction,
-                'from_group': 'discord/' + str(interaction.channel.id),
+                'from_group': utils.group_key('discord', interaction.channel.id),
             })
 
         @bot.tree.command(description="查看 IRC 在线用户的 WHOIS 信息")
         @app_commands.describe(target="要查看的昵称，必须在线")
         async def ircwhois(interaction: discord.Interaction, target: str):
-            if ('discord/' + str(interaction.channel.id)) not in (await utils.get_bridge_map()):
+            if interaction.channel.id not in utils.get_bridge_ids_nowait('discord'):
                 return
-            logger.info(f'Discord {interaction.channel.id} incoming /ircwhois: ' + str(interaction.message))
+            logger.debug('Discord %s incoming /ircwhois: %s', interaction.channel.id, interaction.message)
             await message_queue.put({
                 'action': 'ircwhois',
                 'target': target,
                 'event': interaction,
-                'from_group': 'discord/' + str(interaction.channel.id),
+                'from_group': utils.group_key('discord', interaction.channel.id),
             })
 
         @bot.tree.command(description="查看 IRC 离线用户的 WHOWAS 信息")
         @app_commands.describe(target="要查看的昵称，必须离线")
         async def ircwhowas(interaction: discord.Interaction, target: str):
-            if ('discord/' + str(interaction.channel.id)) not in (await utils.get_bridge_map()):
+            if interaction.channel.id not in utils.get_bridge_ids_nowait('discord'):
                 return
-            logger.info(f'Discord {interaction.channel.id} incoming /ircwhowas: ' + str(interaction.message))
+            logger.debug('Discord %s incoming /ircwhowas: %s', interaction.channel.id, interaction.message)
             await message_queue.put({
                 'action': 'ircwhowas',
                 'target': target,
                 'event': interaction,
-                'from_group': 'discord/' + str(interaction.channel.id),
+                'from_group': utils.group_key('discord', interaction.channel.id),
             })
 
         @bot.event
@@ -121,9 +162,9 @@ class Discord(MessagingPlatform):
             # Don't echo self
             if message.author == bot.user:
                 return
-            if ('discord/' + str(message.channel.id)) not in (await utils.get_bridge_map()):
+            if message.channel.id not in utils.get_bridge_ids_nowait('discord'):
                 return
-            logger.info(f'Discord {message.channel.id} incoming message: ' + str(message))
+            logger.debug('Discord %s incoming message: %s', message.channel.id, message)
             files = await self.download_media(message)
             await message_queue.put(await Message.create(message, files=files))
 
@@ -133,14 +174,14 @@ class Discord(MessagingPlatform):
             Discord listener that detects when a message is deleted.
             I am glad that it is much more reliable than the telegram listener.
             """
-            group = 'discord/' + str(message.channel.id)
-            if group not in (await utils.get_bridge_map()):
+            if message.channel.id not in utils.get_bridge_ids_nowait('discord'):
                 return
-            logger.info(f'Discord message {message.id} were deleted in {message.channel.id}')
+            group = utils.group_key('discord', message.channel.id)
+            logger.info('Discord message %s were deleted in %s', message.id, message.channel.id)
             msg_doc = await db.find_bridged_messages_to_update(group, message.id)
             if not msg_doc or msg_doc.get('deleted') or not msg_doc.get('bridge_messages'):
                 return
-            logger.info(f'Messages to be deleted in bridged groups: {msg_doc.get("bridge_messages")}')
+            logger.info('Messages to be deleted in bridged groups: %s', msg_doc.get('bridge_messages'))
             # Put the request into queue for workers to actually delete messages
             await message_queue.put({'action': 'delete', 'body': msg_doc})
             await db.delete_message_record(msg_doc)
@@ -151,18 +192,23 @@ class Discord(MessagingPlatform):
             Discord listener that detects when messages are bulk deleted.
             This may happen when e.g. an admin banned a member and deletes all their messages.
             """
+            # Bulk deleted messages are from one channel, but group them by channel in case it changes
+            channel_ids: 'dict[int, list[int]]' = defaultdict(list)
             for message in messages:
-                group = 'discord/' + str(message.channel.id)
-                if group not in (await utils.get_bridge_map()):
-                    continue
-                logger.info(f'Discord message {message.id} were bulk deleted in {message.channel.id}')
-                msg_doc = await db.find_bridged_messages_to_update(group, message.id)
-                if not msg_doc or msg_doc.get('deleted') or not msg_doc.get('bridge_messages'):
+                if message.channel.id in utils.get_bridge_ids_nowait('discord'):
+                    channel_ids[message.channel.id].append(message.id)
+            for channel_id, message_ids in channel_ids.items():
+                group = utils.group_key('discord', channel_id)
+                logger.info('Discord message %s were bulk deleted in %s', message_ids, channel_id)
+                # One query for all messages of the channel
+                to_delete = [msg_doc for msg_doc in await db.find_bridged_messages_to_update_many(group, message_ids)
+                             if msg_doc.get('bridge_messages')]
+                if not to_delete:
                     continue
-                logger.info(f'Messages to be deleted in bridged groups: {msg_doc.get("bridge_messages")}')
+                logger.info('Messages to be deleted in bridged groups: %s', to_delete)
                 # Put the request into queue for workers to actually delete messages
-                await message_queue.put({'action': 'delete', 'body': msg_doc})
-                await db.delete_message_record(msg_doc)
+                await message_queue.put({'action': 'delete', 'body': to_delete})
+                await db.delete_message_records(to_delete)
 
         @bot.event
         async def on_message_edit(_, message):
@@ -171,36 +217,62 @@ class Discord(MessagingPlatform):
 
             It takes two arguments: before and after. We do not need the before one.
             """
-            group = 'discord/' + str(message.channel.id)
-            if group not in (await utils.get_bridge_map()):
+            if message.channel.id not in utils.get_bridge_ids_nowait('discord'):
                 return
+            group = utils.group_key('discord', message.channel.id)
             if message.author == bot.user:
                 return
-            logger.info(f'Discord message {message.id} were edited in {message.channel.id}')
+            logger.info('Discord message %s were edited in %s', message.id, message.channel.id)
             msg_doc = await db.find_bridged_messages_to_update(group, message.id)
             if not msg_doc or not msg_doc.get('bridge_messages'):
                 return
 
-            files = await self.download_media(message)
+            old_files = [File.from_doc(f) for f in msg_doc.get('files', []) if f]
+            if [attachment.id for attachment in message.attachments] == [f.metadata.get('media_id') for f in old_files]:
+                # Attachments are not changed, reuse the downloaded files
+                files = old_files
+            else:
+                files = await self.download_media(message)
             # Update the message internally
-            await msg_collection.update_one({'_id': msg_doc.get('_id')}, {
+            db.update_message(msg_doc.get('_id'), {
                 '$set': {
                     'edited_at': message.edited_at,
                     'text': message.content,
-                    'files': [vars(file) for file in files],
+                    'files': [file.to_doc() for file in files],
                 }
             })
-            logger.info(f'Messages to be edited in bridged groups: {msg_doc.get("bridge_messages")}')
+            logger.info('Messages to be edited in bridged groups: %s', msg_doc.get('bridge_messages'))
             new_message = await Message.create(message, files=files)
             await message_queue.put({'action': 'edit', 'body': {'to_edit': msg_doc, 'new_message': new_message}})
 
-    def construct_files(self, files: list[File]) -> list[discord.File]:
+    async def read_files(self, files: list[File]) -> 'dict[str, bytes]':
+        """
+        Read the content of files in threads, so a message sent to several channels is read from disk only once.
+
+        Return: dict of path -> content. Files which cannot be read are left out.
+        """
+        paths = [file.path for file in files if not file.is_empty()]
+        contents = await asyncio.gather(*[asyncio.to_thread(self._read_file, path) for path in paths], return_exceptions=True)
+        return {path: content for path, content in zip(paths, contents) if type(content) is bytes}
+
+    @staticmethod
+    def _read_file(path: str) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def construct_files(self, files: list[File], file_data: 'dict[str, bytes]'=None) -> list[discord.File]:
+        """
+        file_data: contents of files returned by read_files(); other files are read from their paths when sent.
+        """
         ret = []
         for file in files:
             if file.is_empty(): continue
+            data = file_data.get(file.path) if file_data else None
             ret.append(discord.File(
-                file.path,
-                spoiler=file.metadata.get('is_spoiler', False),
-                description=file.metadata.get('description', '')
+                # discord.File objects can only be sent once, but the bytes can be shared
+                io.BytesIO(data) if data is not None else file.path,
+                filename=os.path.basename(file.path),
+                spoiler=file.is_spoiler,
+                description=file.description or ''
             ))
         return ret
@@ -1,47 +1,118 @@
+import functools
+import logging
 import re
+from collections import defaultdict
+from typing import Callable
 from .config import Config
 from .message import Message
+from .utils import PLATFORMS
+
+config = Config('bridge.yaml')
+logger = logging.getLogger(__name__)
+try:
+    logger.setLevel(config.get_nowait('Logging', 'level', default='INFO'))
+except ValueError:
+    # Unknown level, use default INFO level
+    pass
+# google-re2 matches in linear time, so user-written patterns cannot hang the worker by backtracking
+re2 = None
+if Config('filter.yaml').get_nowait('use_re2', default=False):
+    try:
+        import re2
+    except ImportError:
+        logger.warning('use_re2 is enabled in filter.yaml but google-re2 is not installed, using re instead')
+
+@functools.lru_cache(maxsize=512)
+def compile_pattern(pattern: str) -> 'Callable[[str], object]':
+    """
+    Compile a pattern in filter.yaml, cached so that each pattern is compiled only once.
+    Keyed by the pattern string, so new patterns are compiled when the config is reloaded.
+
+    Return: a function taking the string to search, whose result is truthy if the pattern is found.
+    """
+    if re.escape(pattern) == pattern:
+        # No special characters, so a plain substring test does the same without the regex engine
+        return lambda string: pattern in string
+    if re2:
+        try:
+            return re2.compile(pattern).search
+        except re2.error as e:
+            # re2 does not support some features like backreferences and lookarounds
+            logger.warning(f'Filter pattern {pattern} is not supported by re2, using re instead: {e}')
+    return re.compile(pattern).search
+
+@functools.lru_cache(maxsize=512)
+def pattern_platforms(pattern: str) -> 'tuple[str, ...]':
+    """
+    Return the platforms whose groups may be matched by a group pattern in filter.yaml.
+    Only patterns starting with ^ and literal text are narrowed down; other patterns may match groups of any platform.
+    """
+    # Unanchored patterns may match anywhere, and alternation may match without the anchored part
+    if not pattern.startswith('^') or '|' in pattern:
+        return PLATFORMS
+    prefix = re.match(r'[\w/-]*', pattern[1:]).group()
+    if pattern[1 + len(prefix):][:1] in ('?', '*', '+', '{'):
+        # The literal text is followed by a quantifier, do not try to tell which part of it is required
+        return PLATFORMS
+    return tuple(platform for platform in PLATFORMS
+                 if (platform + '/').startswith(prefix) or prefix.startswith(platform + '/'))
 
 class Filter:
+    # Pairs of (key used in filter.yaml, field used in message objects and mongodb)
+    PROPERTIES = (
+        ('text', 'text'),
+        ('nick', 'from_nick'),
+        ('fwd_from', 'fwd_from'),
+    )
+
     def __init__(self):
         self.config = Config('filter.yaml')
+        # Filters currently indexed, and (event, platform) -> filters whose group pattern may match groups of the platform
+        self._filters = None
+        self._index: 'dict[tuple[str, str], list[dict]]' = dict()
 
-    def get_properties(self) -> dict:
-        return {
-            # Keys: keys used in filter.yaml
-            # Values: fields used in message objects and mongodb
-            'text': 'text',
-            'nick': 'from_nick',
-            'fwd_from': 'fwd_from',
-        }
+    def _build_index(self, filters: 'list[dict]'):
+        index = defaultdict(list)
+        for filter in filters or []:
+            event = filter.get('event') or 'send'
+            if event not in ('send', 'receive'):
+                # Invalid event, never matches
+                continue
+            for platform in pattern_platforms(filter.get('group', '')):
+                index[(event, platform)].append(filter)
+        self._filters, self._index = filters, index
 
     async def test(self, message: Message, to_group: str) -> bool:
         """
         Test if the input message matches any filter.
         """
         filters = await self.config.get('filters')
-        for filter in filters:
+        # Only rebuild when the config is (re)loaded, which replaces the list object
+        if filters is not self._filters:
+            self._build_index(filters)
+        # Skip filters for groups of other platforms
+        from_platform = message.from_group.split('/', 1)[0]
+        to_platform = to_group.split('/', 1)[0]
+        for filter in (*self._index.get(('send', from_platform), ()), *self._index.get(('receive', to_platform), ())):
             event = filter.get('event')
             # Default event is 'send'
             if not event or event == 'send':
-                if not re.search(filter.get('group', ''), message.from_group):
+                if not compile_pattern(filter.get('group', ''))(message.from_group):
                     continue
             elif event == 'receive':
-                if not re.search(filter.get('group', ''), to_group):
+                if not compile_pattern(filter.get('group', ''))(to_group):
                     continue
             else:
                 # Invalid event
                 continue
 
             # Make sure all properties in the filter are matching
-            for key, field in self.get_properties().items():
+            for key, field in self.PROPERTIES:
                 if not filter.get(key):
                     continue
-                try:
-                    if not re.search(filter.get(key), getattr(message, field)):
-                        # This filter does not match
-                        break
-                except AttributeError:
+                value = getattr(message, field, None)
+                if value is None or not compile_pattern(filter.get(key))(value):
+                    # This filter does not match
                     break
             else:
                 return True
@@ -49,10 +120,11 @@ class Filter:
             # If filter reply as well (default is true), check if the replied message matches filter
             if filter.get('filter_reply') == False or not message.reply_to:
                 continue
-            for key, field in self.get_properties().items():
+            for key, field in self.PROPERTIES:
                 if not filter.get(key):
                     continue
-                if not re.search(filter.get(key), message.reply_to.get(field)):
+                value = message.reply_to.get(field)
+                if value is None or not compile_pattern(filter.get(key))(value):
                     break
             else:
                 return True
@@ -4,7 +4,6 @@ import logging
 from . import utils
 from .config import Config
 from .database import MongoDB
-from datetime import datetime
 from .im import MessagingPlatform
 from .message import Message
 
@@ -32,13 +31,12 @@ class IRCBot(pydle.Client):
         """
         # IRC does not send us the time when a message is received
         # so just use the current UTC time
-        received_at = datetime.utcnow()
-        mynick = await config.get('IRC', 'nick')
-        # Don't echo self
-        if source == mynick:
+        received_at = utils.utcnow()
+        # Don't echo self; pydle keeps the current nick, which may differ from config if it was taken
+        if source == self.nickname:
             return
         # Must be in bridge map
-        if 'irc/' + target not in (await utils.get_bridge_map()):
+        if target not in utils.get_bridge_ids_nowait('irc'):
             return
 
         await message_queue.put(await Message.create({
@@ -101,10 +99,12 @@ class IRCBot(pydle.Client):
         groups = await db.get_active_groups_on_platform(host)
         if not groups:
             return
+        # All system messages of one event share the same time
+        created_at = utils.utcnow()
         if kwargs.get('channel'):
             channel = kwargs.get('channel')
             # Check if user is active in this provided channel
-            if ('irc/' + channel) not in groups:
+            if utils.group_key('irc', channel) not in groups:
                 return
             # If active, only send system message to this single channel
             await message_queue.put(await Message.create({
@@ -114,23 +114,22 @@ class IRCBot(pydle.Client):
                 'nick': kwargs.get('nick', ''),
                 'host': host,
                 'group': channel,
-                'created_at': datetime.utcnow(),
+                'created_at': created_at,
             }))
             return
 
         # Broadcast system message to all channels the user is active in
-        for group in groups:
-            # The results from db have platform prefix, but we don't need it to construct a Message object
-            _, group_id = group.split('/', 1)
-            await message_queue.put(await Message.create({
-                'system': True,
-                'text': message_text,
-                # Record user info in system message for future commands against it like /ircban
-                'nick': kwargs.get('nick', ''),
-                'host': host,
-                'group': group_id,
-                'created_at': datetime.utcnow(),
-            }))
+        # The results from db have platform prefix, but we don't need it to construct a Message object
+        messages = await asyncio.gather(*[Message.create({
+            'system': True,
+            'text': message_text,
+            # Record user info in system message for future commands against it like /ircban
+            'nick': kwargs.get('nick', ''),
+            'host': host,
+            'group': group.split('/', 1)[1],
+            'created_at': created_at,
+        }) for group in groups])
+        await message_queue.put_many(messages)
 
 class IRC(MessagingPlatform):
     """
@@ -5,7 +5,7 @@ import telethon
 import urllib.parse
 from .config import Config
 from .database import MongoDB
-from .utils import normurl
+from .utils import group_key, normurl
 from uuid import uuid4
 
 # Maximum number of media files per message, other files will be ignored
@@ -14,6 +14,17 @@ MAX_FILES_PER_MSG = 10
 
 config = Config('bridge.yaml')
 db = MongoDB()
+# Settings used for every message, read once at startup
+PLATFORM_PREFIXES = {
+    'telegram': config.get_nowait('Telegram', 'platform_prefix', default='T'),
+    'discord': config.get_nowait('Discord', 'platform_prefix', default='D'),
+    'irc': config.get_nowait('IRC', 'platform_prefix', default='I'),
+}
+TG_NICK_STYLE = config.get_nowait('Telegram', 'nick_style', default='username')
+DC_NICK_STYLE = config.get_nowait('Discord', 'nick_style', default='nickname')
+FILES_UPLOAD = config.get_nowait('Files', 'upload')
+FILES_URL = normurl(config.get_nowait('Files', 'url'))
+IRC_COMMAND_REGEX = config.get_nowait('IRC', 'command_regex')
 
 # Util functions
 async def get_tg_nick(sender):
@@ -24,7 +35,7 @@ async def get_tg_nick(sender):
     first = sender.first_name + ' ' or ' '
     last = sender.last_name or ''
     first_last = (first + last).strip()
-    if (await config.get('Telegram', 'nick_style', default='username')) == 'username':
+    if TG_NICK_STYLE == 'username':
         # Use username over first_name last_name
         return username or first_last
     else:
@@ -64,8 +75,7 @@ async def get_relay_message(message, target_platform: str) -> str:
 
     text = message.text
     if target_platform == 'irc':
-        cmd_regex = await config.get('IRC', 'command_regex')
-        if cmd_regex and re.search(cmd_regex, text):
+        if IRC_COMMAND_REGEX and re.search(IRC_COMMAND_REGEX, text):
             # Treat as an IRC command, so prepend a new line to message text
             text = '\n' + text
 
@@ -111,8 +121,13 @@ async def get_deleted_message(old_messages: list[dict]) -> str:
 class File:
     """
     The media files used in message attachments.
+
+    Attributes read when sending files are promoted out of metadata; other attributes stay in metadata.
     """
-    def __init__(self, type: str, path: str, ext: str='', **kwargs):
+    __slots__ = ('type', 'path', 'url', 'ext', 'filename', 'description', 'is_spoiler', 'metadata', '_doc')
+
+    def __init__(self, type: str, path: str, ext: str='', filename: str=None, description: str=None,
+                 is_spoiler: bool=False, **kwargs):
         self.type = type
         # Location of this file in internal storage
         self.path = path
@@ -122,7 +137,44 @@ class File:
         if not self.ext:
             # Infer from path
             self.ext = self.path.split('.')[-1] if '.' in self.path else ''
+        self.filename = filename
+        self.description = description
+        self.is_spoiler = is_spoiler
         self.metadata = kwargs
+        self._doc = None
+
+    @classmethod
+    def from_doc(cls, doc: dict):
+        """
+        Rebuild a File from its dict stored in database.
+        """
+        file = cls(doc.get('type', ''), doc.get('path', ''), doc.get('ext', ''), **doc.get('metadata', {}))
+        file.url = doc.get('url', '')
+        return file
+
+    def to_doc(self) -> dict:
+        """
+        Convert to a dict to store in database. Promoted attributes are stored in metadata as well.
+
+        The dict is built once and reused, since a file is not changed after it is uploaded and stored.
+        """
+        if self._doc is None:
+            self._doc = self._build_doc()
+        return self._doc
+
+    def _build_doc(self) -> dict:
+        return {
+            'type': self.type,
+            'path': self.path,
+            'url': self.url,
+            'ext': self.ext,
+            'metadata': {
+                **self.metadata,
+                'filename': self.filename,
+                'description': self.description,
+                'is_spoiler': self.is_spoiler,
+            },
+        }
 
     def __repr__(self) -> str:
         return self.__str__()
@@ -160,9 +212,9 @@ class File:
         if self.is_empty() or self.url:
             # Empty file or already uploaded
             return False
-        if (await config.get('Files', 'upload')) == 'self':
+        if FILES_UPLOAD == 'self':
             filename_url = urllib.parse.quote(os.path.basename(self.path))
-            self.url = normurl(await config.get('Files', 'url')) + filename_url
+            self.url = FILES_URL + filename_url
             return True
         # TODO: implement other upload methods (i.e. to public media hosting websites)
         return False
@@ -217,9 +269,9 @@ class Message:
             # TODO: Make nickname of anonymous sender configurable
             self.from_user_id = message.sender_id
             self.from_nick = (await get_tg_nick(message.sender)) or 'Anonymous'
-            self.from_group = 'telegram/' + str(message.chat_id)
+            self.from_group = group_key('telegram', message.chat_id)
             self.from_message_id = message.id
-            self.platform_prefix = await config.get('Telegram', 'platform_prefix', default='T')
+            self.platform_prefix = PLATFORM_PREFIXES['telegram']
             self.created_at = message.date
             self.edited_at = message.edit_date
             if message.forward:
@@ -237,13 +289,13 @@ class Message:
             # Discord message
             self.text = message.content
             self.from_user_id = message.author.id
-            if (await config.get('Discord', 'nick_style', default='nickname')) == 'nickname':
+            if DC_NICK_STYLE == 'nickname':
                 self.from_nick = message.author.display_name
             else:
                 self.from_nick = message.author.name
-            self.from_group = 'discord/' + str(message.channel.id)
+            self.from_group = group_key('discord', message.channel.id)
             self.from_message_id = message.id
-            self.platform_prefix = await config.get('Discord', 'platform_prefix', default='D')
+            self.platform_prefix = PLATFORM_PREFIXES['discord']
             self.created_at = message.created_at
             self.edited_at = message.edited_at
             if message.reference and not message.is_system():
@@ -257,9 +309,9 @@ class Message:
             self.text = message.get('text', '')
             self.from_user_id = message.get('host', '')
             self.from_nick = message.get('nick', '')
-            self.from_group = 'irc/' + message.get('group', '')
+            self.from_group = group_key('irc', message.get('group', ''))
             self.from_message_id = None  # IRC does not have message ids
-            self.platform_prefix = await config.get('IRC', 'platform_prefix', default='I')
+            self.platform_prefix = PLATFORM_PREFIXES['irc']
             self.created_at = message.get('created_at')
         else:
             raise TypeError('Unknown message type')
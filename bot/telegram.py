@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import random
 from . import utils
 from .config import Config
 from .database import MongoDB
@@ -18,6 +19,48 @@ except ValueError:
 db = MongoDB()
 msg_collection = db.collection
 message_queue = utils.message_queue
+# Read once, so downloads do not go through the config lock
+FILES_PATH = config.get_nowait('Files', 'path', default='')
+# Telegram refuses to return more than 100 messages per GetMessagesRequest
+GET_MESSAGES_LIMIT = 100
+# Number of most recent messages in each group checked by the deleted poller
+RECENT_MESSAGES_LIMIT = 500
+# Seconds between two polls of the same group: short right after deletions are found,
+# then doubled on each poll without deletions up to the maximum
+MIN_POLL_INTERVAL = 1
+MAX_POLL_INTERVAL = 10
+# Give up a GetMessagesRequest after this many flood waits
+FLOOD_WAIT_RETRIES = 8
+# (attribute, metadata key) pairs copied from document attributes and photo sizes
+DOCUMENT_ATTRS = (('alt', 'alt'), ('w', 'width'), ('h', 'height'), ('size', 'size'), ('duration', 'duration'), ('file_name', 'filename'))
+PHOTO_SIZE_ATTRS = (('w', 'width'), ('h', 'height'), ('size', 'size'))
+# Limit concurrent GetMessagesRequest calls to avoid flood waits
+get_messages_semaphore = asyncio.Semaphore(4)
+# Limit concurrent media downloads, so a burst of large files does not hold all connections
+download_semaphore = asyncio.Semaphore(8)
+# A worker holds the lock of the source group while sending, so give up sending instead of
+# waiting longer than this for one flood wait, or after this many attempts (at most about 2 minutes in total)
+MAX_FLOOD_WAIT = 60
+SEND_ATTEMPTS = 3
+
+async def retry_on_flood_wait(request, attempts: int=SEND_ATTEMPTS):
+    """
+    Await request() and retry it when Telegram asks to wait, with exponential backoff and jitter.
+
+    request: a function returning a new coroutine on each call, e.g. lambda: bot.send_message(...)
+    Raises the last FloodWaitError if still rate limited after all attempts, or asked to wait longer than MAX_FLOOD_WAIT.
+    """
+    for attempt in range(attempts):
+        try:
+            return await request()
+        except errors.FloodWaitError as e:
+            if attempt == attempts - 1 or e.seconds > MAX_FLOOD_WAIT:
+                logger.warning(f'Giving up after {attempt + 1} attempt(s), Telegram asks to wait {e.seconds} seconds')
+                raise
+            # Never retry earlier than Telegram asks for
+            delay = max(e.seconds, 2 ** attempt) + random.uniform(0, 1)
+            logger.info('FloodWaitError on attempt %s: sleep %.1f seconds', attempt + 1, delay)
+            await asyncio.sleep(delay)
 
 class Telegram(MessagingPlatform):
     """
@@ -32,6 +75,8 @@ class Telegram(MessagingPlatform):
                 config.get_nowait('Telegram', 'api_hash')
             )
             self.bot.start(bot_token=config.get_nowait('Telegram', 'bot_token'))
+            # Group -> ids of recent messages to poll, see track_messages()
+            self.recent_ids: 'dict[str, dict[int, None]]' = {}
             self.register_listeners()
 
     async def download_media(self, message: types.Message) -> Optional[File]:
@@ -49,19 +94,20 @@ class Telegram(MessagingPlatform):
                 document = message.media.document
                 metadata['size'] = document.size
                 for attr in document.attributes:
-                    if hasattr(attr, 'alt'): metadata['alt'] = attr.alt
-                    if hasattr(attr, 'w'): metadata['width'] = attr.w
-                    if hasattr(attr, 'h'): metadata['height'] = attr.h
-                    if hasattr(attr, 'size'): metadata['size'] = attr.size
-                    if hasattr(attr, 'duration'): metadata['duration'] = attr.duration
-                    if hasattr(attr, 'file_name'): metadata['filename'] = attr.file_name
+                    for name, key in DOCUMENT_ATTRS:
+                        value = getattr(attr, name, None)
+                        if value is not None: metadata[key] = value
+        media_id = self.get_media_id(message)
+        if media_id:
+            # To tell whether the media is changed when the message is edited
+            metadata['media_id'] = media_id
         if message.photo:
             media_type = 'photo'
             # MessageMediaPhoto attributes
             for size in message.photo.sizes:
-                if hasattr(size, 'w'): metadata['width'] = size.w
-                if hasattr(size, 'h'): metadata['height'] = size.h
-                if hasattr(size, 'size'): metadata['size'] = size.size
+                for name, key in PHOTO_SIZE_ATTRS:
+                    value = getattr(size, name, None)
+                    if value is not None: metadata[key] = value
         elif message.sticker:
             media_type = 'sticker'
         elif message.gif:
@@ -81,26 +127,39 @@ class Telegram(MessagingPlatform):
         path = ''
         if media_type != 'unsupported':
             try:
-                path = await message.download_media(await config.get('Files', 'path', default=''))
+                # Telethon streams the file to disk in chunks, so memory use does not grow with file size
+                async with download_semaphore:
+                    path = await message.download_media(FILES_PATH)
             except errors.RPCError as e:
                 logger.warning(f'Downloading telegram attachment from {message} failed: {e}')
                 path = ''
         ret = File(media_type, path, **metadata)
-        logger.info(f'Downloaded Telegram file: {ret}, path: {path}, is_empty: {ret.is_empty()}, metadata: {ret.metadata}')
+        logger.info('Downloaded Telegram file: %s, path: %s, metadata: %s', ret, path, ret.metadata)
         if ret.is_empty():
             return None
         if not (await ret.upload()):
-            logger.info(f'Warning: failed to upload Telegram file at {path}')
+            logger.info('Warning: failed to upload Telegram file at %s', path)
         return ret
 
+    @staticmethod
+    def get_media_id(message: types.Message) -> Optional[int]:
+        """
+        Return: id of the photo or document in a message, or None if it has neither.
+        """
+        if message.photo:
+            return message.photo.id
+        if message.document:
+            return message.document.id
+        return None
+
     def register_listeners(self):
         bot = self.bot
 
         @bot.on(events.NewMessage(incoming=True, pattern=r'^/ircnames($|[ @])'))
         async def ircnames(event):
-            if ('telegram/' + str(event.chat_id)) not in (await utils.get_bridge_map()):
+            if event.chat_id not in utils.get_bridge_ids_nowait('telegram'):
                 return
-            logger.info(f'Telegram {event.chat_id} incoming /ircnames: ' + str(event.message))
+            logger.debug('Telegram %s incoming /ircnames: %s', event.chat_id, event.message)
             # Parse argument as the IRC nick to find
             tmp = event.message.text.split(' ', 1)
             target = None if len(tmp) < 2 else tmp[1]
@@ -108,14 +167,14 @@ class Telegram(MessagingPlatform):
                 'action': 'ircnames',
                 'target': target,
                 'event': event,
-                'from_group': 'telegram/' + str(event.message.chat_id),
+                'from_group': utils.group_key('telegram', event.message.chat_id),
             })
 
         @bot.on(events.NewMessage(incoming=True, pattern=r'^/ircwho(i|wa)s($|[ @])'))
         async def ircwhox(event):
-            if ('telegram/' + str(event.chat_id)) not in (await utils.get_bridge_map()):
+            if event.chat_id not in utils.get_bridge_ids_nowait('telegram'):
                 return
-            logger.info(f'Telegram {event.chat_id} incoming /ircwhox: ' + str(event.message))
+            logger.debug('Telegram %s incoming /ircwhox: %s', event.chat_id, event.message)
             # Parse argument as the IRC nick to find
             tmp = event.message.text.split(' ', 1)
             if len(tmp) < 2:
@@ -125,7 +184,7 @@ class Telegram(MessagingPlatform):
                 'action': 'ircwhois' if tmp[0].startswith('/ircwhois') else 'ircwhowas',
                 'target': target,
                 'event': event,
-                'from_group': 'telegram/' + str(event.message.chat_id),
+                'from_group': utils.group_key('telegram', event.message.chat_id),
             })
 
         @bot.on(events.NewMessage(incoming=True))
@@ -134,14 +193,14 @@ class Telegram(MessagingPlatform):
             Telegram listener serves as a producer to add new messages to queue.
             """
             # Telegram bots cannot see self messages so we are fine
-            if ('telegram/' + str(event.chat_id)) not in (await utils.get_bridge_map()):
+            if event.chat_id not in utils.get_bridge_ids_nowait('telegram'):
                 return
             # Albums are handled otherwise
             if event.grouped_id:
                 return
-            logger.info(f'Telegram {event.chat_id} incoming message: ' + str(event.message))
+            logger.debug('Telegram %s incoming message: %s', event.chat_id, event.message)
             file = await self.download_media(event.message)
-            logger.info(f'files arg={([file] if file else [])}')
+            logger.debug('files arg=%s', [file] if file else [])
             await message_queue.put(await Message.create(event.message, files=([file] if file else [])))
 
         @bot.on(events.Album)
@@ -150,19 +209,22 @@ class Telegram(MessagingPlatform):
             Since albums in Telegram are sent to client as consecutive new message updates,
             we need a standalone handler for this instead of inventing wheels to deal with that
             """
-            if ('telegram/' + str(event.chat_id)) not in (await utils.get_bridge_map()):
+            if event.chat_id not in utils.get_bridge_ids_nowait('telegram'):
                 return
 
             # Counting how many photos or videos the album has
-            logger.info(f'Telegram {event.chat_id} incoming album with {len(event)} items: {event.text}')
+            logger.info('Telegram %s incoming album with %d items: %s', event.chat_id, len(event), event.text)
 
+            # Download media of all album messages concurrently
+            results = await asyncio.gather(*[self.download_media(msg) for msg in event.messages], return_exceptions=True)
             files = []
-            for i in range(len(event)):
-                # Download media for each album message
-                file = await self.download_media(event.messages[i])
+            for msg, file in zip(event.messages, results):
+                if isinstance(file, Exception):
+                    logger.warning(f'Downloading telegram attachment from {msg} failed: {file}')
+                    continue
                 if file:
-                    if event.messages[i].message:
-                        file.metadata['description'] = event.messages[i].message
+                    if msg.message:
+                        file.description = msg.message
                     files.append(file)
 
             # Note: only caption of the first message is retained. Others are discarded.
@@ -176,21 +238,16 @@ class Telegram(MessagingPlatform):
             From telethon doc it isn't 100% reliable. Actually it works like only 1% of the time.
             So we have to implement the polling method as well ¯\_(ツ)_/¯
             """
-            group = 'telegram/' + str(event.chat_id)
-            if group not in (await utils.get_bridge_map()):
+            if event.chat_id not in utils.get_bridge_ids_nowait('telegram'):
                 return
-            logger.info(f'Telegram message {event.deleted_ids} were deleted in {event.chat_id}')
-            to_delete = []
-            for msg_id in event.deleted_ids:
-                msg_doc = await db.find_bridged_messages_to_update(group, msg_id)
-                if not msg_doc or msg_doc.get('deleted') or not msg_doc.get('bridge_messages'):
-                    continue
-                to_delete.append(msg_doc)
-                await db.delete_message_record(msg_doc)
-
+            group = utils.group_key('telegram', event.chat_id)
+            logger.info('Telegram message %s were deleted in %s', event.deleted_ids, event.chat_id)
+            to_delete = [msg_doc for msg_doc in await db.find_bridged_messages_to_update_many(group, event.deleted_ids)
+                         if msg_doc.get('bridge_messages')]
+            await db.delete_message_records(to_delete)
             if not to_delete:
                 return
-            logger.info(f'Messages to be deleted in bridged groups: {to_delete}')
+            logger.info('Messages to be deleted in bridged groups: %s', to_delete)
             await message_queue.put({'action': 'delete', 'body': to_delete})
 
         # TODO: compare old/new messages, do not re-download and re-upload same files
@@ -199,102 +256,193 @@ class Telegram(MessagingPlatform):
             """
             Telegram listener that detects when messages are edited.
             """
-            group = 'telegram/' + str(event.chat_id)
-            if group not in (await utils.get_bridge_map()):
+            if event.chat_id not in utils.get_bridge_ids_nowait('telegram'):
                 return
-            logger.info(f'Telegram message {event.message.id} were edited in {event.chat_id}')
+            group = utils.group_key('telegram', event.chat_id)
+            logger.info('Telegram message %s were edited in %s', event.message.id, event.chat_id)
             msg_doc = await db.find_bridged_messages_to_update(group, event.message.id)
             if not msg_doc or not msg_doc.get('bridge_messages'):
                 return
 
-            file = await self.download_media(event.message)
+            media_id = self.get_media_id(event.message)
+            old_files = [File.from_doc(f) for f in msg_doc.get('files', []) if f]
+            if media_id and len(old_files) == 1 and old_files[0].metadata.get('media_id') == media_id:
+                # Only the caption is edited, reuse the downloaded media
+                file = old_files[0]
+            else:
+                file = await self.download_media(event.message)
             # Update the message internally
-            await msg_collection.update_one({'_id': msg_doc.get('_id')}, {
+            db.update_message(msg_doc.get('_id'), {
                 '$set': {
                     'edited_at': event.message.edit_date,
                     'text': event.message.text,
-                    'files': [vars(file) if file else []],
+                    'files': [file.to_doc()] if file else [],
                 }
             })
 
-            logger.info(f'Messages to be edited in bridged groups: {msg_doc.get("bridge_messages")}')
+            logger.info('Messages to be edited in bridged groups: %s', msg_doc.get('bridge_messages'))
             new_message = await Message.create(event.message, files=([file] if file else []))
             await message_queue.put({'action': 'edit', 'body': {'to_edit': msg_doc, 'new_message': new_message}})
 
-    async def deleted_poller(self):
+    async def get_messages(self, chat_id: int, msg_ids: list[int]) -> list:
         """
-        Poll the admin log to get recent deleted messages.
-        The bot needs to be an admin (regardless of rights) in each group.
+        Fetch messages by ids from a channel, at most GET_MESSAGES_LIMIT ids per request.
+
+        Return: list of messages in the same order as msg_ids, or None if the request failed.
         """
-        # Wait for other platforms to initialize
-        await asyncio.sleep(30)
-        while True:
-            # Poll outbound telegram groups only
-            for group in (await utils.get_bridge_map()):
-                if not group.startswith('telegram/'):
-                    continue
-                chat_id = int(group.split('/', 1)[1])
-                # Only check the most recent 500 messages
-                messages = msg_collection.find({
-                    'bridge_messages.group': group,
-                }).sort({'_id': -1}).limit(500)
-                messages = await messages.to_list(None)
-                # logger.info(f'Poller got {len(messages)} messages for group {group}')
-                msg_ids = []
-                for message in messages:
-                    # Extract message ids to poll (all messages from current group) from bridge_messages field
-                    msg_ids.extend([d.get('message_id') for d in message.get('bridge_messages', []) if d.get('group') == group])
-                if not msg_ids:
-                    continue
-                # logger.info(f'Poller got {len(msg_ids)} msg_ids: {msg_ids}')
+        for attempt in range(FLOOD_WAIT_RETRIES):
+            async with get_messages_semaphore:
                 try:
                     # Return type is ChannelMessages
                     msgs = await self.bot(functions.channels.GetMessagesRequest(
                         channel=chat_id,
                         id=msg_ids,
                     ))
-                    msgs = msgs.messages
+                    return msgs.messages
                 except errors.FloodWaitError as e:
-                    logger.info(f'FloodWaitError in deleted_poller: sleep {e.seconds} seconds')
-                    await asyncio.sleep(e.seconds)
+                    # Back off exponentially with jitter, but never less than Telegram asks for
+                    delay = max(e.seconds, 2 ** attempt) + random.uniform(0, 1)
+                    logger.info(f'FloodWaitError in deleted_poller: sleep {delay:.1f} seconds')
                 except errors.RPCError as e:
                     logger.warn(f'Poller error on GetMessagesRequest: {e}')
-                    pass
-                # logger.info(f'Poller got {len(msgs)} msgs: {msgs}')
-                # Find holes in messages
-                to_delete = []
-                for i in range(len(msgs)):
-                    if type(msgs[i]) is types.MessageEmpty or msgs[i] is None:
-                        msg_doc = await db.find_bridged_messages_to_update(group, msg_ids[i])
-                        if not msg_doc or msg_doc.get('deleted') or not msg_doc.get('bridge_messages'):
-                            continue
-                        to_delete.append(msg_doc)
-                        await db.delete_message_record(msg_doc)
-                if not to_delete:
-                    continue
-                logger.info(f'Messages to be deleted in bridged groups: {to_delete}')
-                await message_queue.put({'action': 'delete', 'body': to_delete})
-                # Sleep before checking next group
-                await asyncio.sleep(1)
+                    return None
+            # Do not wait for nothing after the last attempt
+            if attempt < FLOOD_WAIT_RETRIES - 1:
+                await asyncio.sleep(delay)
+        logger.warning(f'Poller gave up GetMessagesRequest in {chat_id} after {FLOOD_WAIT_RETRIES} flood waits')
+        return None
+
+    async def load_recent_ids(self, group: str):
+        """
+        Load ids of the most recent messages in the given telegram group from database.
+        """
+        # Published first, so track_messages() records ids of messages sent while loading
+        live_ids = self.recent_ids[group] = {}
+        # Only message ids are needed
+        cursor = msg_collection.find({
+            'bridge_messages.group': group,
+            'deleted': False,
+        }, projection={'_id': 0, 'bridge_messages': 1}).sort({'_id': -1}).limit(RECENT_MESSAGES_LIMIT).batch_size(GET_MESSAGES_LIMIT)
+        bridge_messages = [message.get('bridge_messages', []) async for message in cursor]
+        # Oldest first, so that track_messages() drops the oldest ones
+        ids = {
+            bridge_message.get('message_id'): None
+            for messages in reversed(bridge_messages) for bridge_message in messages
+            if bridge_message.get('group') == group and bridge_message.get('message_id') is not None
+        }
+        # Ids tracked while loading are the newest, so they go after the loaded ones
+        for message_id in live_ids:
+            ids.pop(message_id, None)
+        ids.update(live_ids)
+        self.recent_ids[group] = dict.fromkeys(list(ids)[-RECENT_MESSAGES_LIMIT:])
+
+    def track_messages(self, bridge_messages: list[dict]):
+        """
+        Remember telegram message ids in bridge_messages so the poller can check if they are deleted.
+        Only the most recent RECENT_MESSAGES_LIMIT messages are kept for each group.
+        """
+        for bridge_message in bridge_messages:
+            group, message_id = bridge_message.get('group'), bridge_message.get('message_id')
+            # Groups not loaded yet will be loaded from database by the poller
+            if group not in self.recent_ids or message_id is None:
+                continue
+            # Dicts are ordered, so they are used as ordered sets
+            ids = self.recent_ids[group]
+            ids[message_id] = None
+            if len(ids) > RECENT_MESSAGES_LIMIT:
+                del ids[next(iter(ids))]
 
-            # Sleep after finishing a loop of all chats
-            await asyncio.sleep(3)
+    async def poll_group(self, group: str, chat_id: int) -> bool:
+        """
+        Check whether recent messages in the given telegram group still exist.
+
+        Return: whether any deleted messages were found.
+        """
+        if group not in self.recent_ids:
+            await self.load_recent_ids(group)
+        msg_ids = list(self.recent_ids[group])
+        if not msg_ids:
+            return False
+        # logger.info(f'Poller got {len(msg_ids)} msg_ids: {msg_ids}')
+        chunks = [msg_ids[i:i+GET_MESSAGES_LIMIT] for i in range(0, len(msg_ids), GET_MESSAGES_LIMIT)]
+        results = await asyncio.gather(*[self.get_messages(chat_id, chunk) for chunk in chunks], return_exceptions=True)
+        # Find holes in messages
+        holes = []
+        for chunk, msgs in zip(chunks, results):
+            if msgs is None or isinstance(msgs, BaseException):
+                # Request failed, so we know nothing about this chunk
+                continue
+            holes.extend(msg_id for msg, msg_id in zip(msgs, chunk) if msg is None or isinstance(msg, types.MessageEmpty))
+        for msg_id in holes:
+            # No need to check it again
+            self.recent_ids[group].pop(msg_id, None)
+        to_delete = [msg_doc for msg_doc in await db.find_bridged_messages_to_update_many(group, holes)
+                     if msg_doc.get('bridge_messages')]
+        await db.delete_message_records(to_delete)
+        if not to_delete:
+            return bool(holes)
+        logger.info('Messages to be deleted in bridged groups: %s', to_delete)
+        await message_queue.put({'action': 'delete', 'body': to_delete})
+        return True
 
-    def construct_files(self, files: list[File]) -> tuple[list[str], list[str], list[types.DocumentAttributeFilename]]:
+    async def deleted_poller(self):
+        """
+        Poll the admin log to get recent deleted messages.
+        The bot needs to be an admin (regardless of rights) in each group.
+
+        Message ids to poll are loaded from database once, then kept up to date by the worker
+        with track_messages(), so the database is not queried on every loop.
+        """
+        # Wait for other platforms to initialize
+        await asyncio.sleep(30)
+        tasks: 'dict[str, asyncio.Task]' = {}
+        while True:
+            # Poll each outbound telegram group in its own task, and start tasks for groups added to config
+            for group, chat_id in utils.get_platform_groups_nowait('telegram'):
+                if group not in tasks or tasks[group].done():
+                    tasks[group] = asyncio.create_task(self.poll_group_forever(group, int(chat_id)))
+            # Check again when the config is reloaded, or every minute in case a task stopped
+            try:
+                await asyncio.wait_for(utils.reload_event.wait(), timeout=60)
+            except asyncio.TimeoutError:
+                pass
+            utils.reload_event.clear()
+
+    async def poll_group_forever(self, group: str, chat_id: int):
+        """
+        Poll the given telegram group until it is removed from config.
+        """
+        # Spread groups over time instead of sending requests for all of them at once
+        await asyncio.sleep(random.uniform(0, MAX_POLL_INTERVAL))
+        interval = MAX_POLL_INTERVAL
+        while chat_id in utils.get_bridge_ids_nowait('telegram'):
+            try:
+                found = await self.poll_group(group, chat_id)
+            except Exception as e:
+                logger.warning(f'Poller error in {group}: {e}')
+                found = False
+            # Deletions often come in bursts, so poll active groups more often
+            interval = MIN_POLL_INTERVAL if found else min(interval * 2, MAX_POLL_INTERVAL)
+            await asyncio.sleep(interval + random.uniform(0, 1))
+
+    def construct_files(self, files: list[File]) -> tuple[list[str], list[str], list[tuple[str, types.DocumentAttributeFilename]]]:
+        """
+        Split files to send into images, other files without a filename, and other files with a filename.
+
+        Return: paths of image files, paths of plain files, and (path, filename attribute) of named files.
+        """
         # Telethon does not provide a way to override default filename.
         # The workaround from https://github.com/LonamiWebs/Telethon/issues/1473 does not work for large files
         # since it requires reading all bytes into memory at once.
-        # Telegram does not allow multiple medias in a message (except album which must be photos) either.
+        # So files with a filename have to be sent one per message, with the filename attribute.
         # Luckily we don't have to bother renaming images since the filename won't be displayed...
-        image_files, other_files, attr = [], [], []
+        image_files, plain_files, named_files = [], [], []
         for file in files:
             if file.is_empty(): continue
             if file.is_image():
                 image_files.append(file.path)
+            elif not file.filename:
+                plain_files.append(file.path)
             else:
-                other_files.append(file.path)
-                if not file.metadata.get('filename'):
-                    attr.append([])
-                else:
-                    attr.append(types.DocumentAttributeFilename(file_name=file.metadata.get('filename')))
-        return image_files, other_files, attr
+                named_files.append((file.path, types.DocumentAttributeFilename(file_name=file.filename)))
+        return image_files, plain_files, named_files
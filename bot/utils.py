@@ -1,5 +1,9 @@
 import asyncio
+import functools
 import logging
+import sys
+from collections import defaultdict, deque
+from datetime import datetime, timezone
 from .config import Config
 
 config = Config('bridge.yaml')
@@ -10,27 +14,207 @@ except ValueError:
     # Unknown level, use default INFO level
     pass
 
+class MessageQueue:
+    """
+    A FIFO queue of messages from listeners to workers.
+
+    It is a deque with events to wake up workers and producers, which is cheaper than asyncio.Queue:
+    putting into a queue that is not full never awaits or creates futures.
+
+    maxsize: listeners wait in put() when the queue has this many messages; 0 means unbounded.
+    """
+
+    def __init__(self, maxsize: int=0):
+        self._maxsize = maxsize
+        self._items = deque()
+        self._nonempty = asyncio.Event()
+        self._notfull = asyncio.Event()
+        self._notfull.set()
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def full(self) -> bool:
+        return 0 < self._maxsize <= len(self._items)
+
+    def put_nowait(self, item):
+        if self.full():
+            raise asyncio.QueueFull
+        self._items.append(item)
+        self._nonempty.set()
+
+    async def put(self, item):
+        """
+        Put an item into the queue, waiting for workers if it is full.
+        """
+        if self.full():
+            logger.warning(f'Message queue is full ({len(self._items)} messages), waiting for workers')
+            while self.full():
+                self._notfull.clear()
+                await self._notfull.wait()
+        self.put_nowait(item)
+
+    async def put_many(self, items: list):
+        """
+        Put several items into the queue at once, so workers see all or none of them.
+        Waits for workers only if the queue is already full; the items may then exceed maxsize.
+        """
+        if not items:
+            return
+        if self.full():
+            logger.warning(f'Message queue is full ({len(self._items)} messages), waiting for workers')
+            while self.full():
+                self._notfull.clear()
+                await self._notfull.wait()
+        self._items.extend(items)
+        self._nonempty.set()
+
+    async def get(self):
+        while not self._items:
+            self._nonempty.clear()
+            await self._nonempty.wait()
+        item = self._items.popleft()
+        self._notfull.set()
+        return item
+
 # The global message queue used by listeners and workers
-message_queue = asyncio.Queue()
+message_queue = MessageQueue(config.get_nowait('Worker', 'queue_size', default=10000))
+
+# Platforms that can be bridged, i.e. the prefixes of groups in config
+PLATFORMS = ('telegram', 'discord', 'irc')
+
+# Bridge config currently indexed, and indexes built from it
+_bridge_cfg = None
+# Group -> list of (connected group, platform, group id without platform prefix, as int for telegram and discord)
+_bridge_map: 'dict[str, list[tuple[str, str, int | str]]]' = dict()
+# Group -> connected groups, for membership tests
+_outbound_groups: 'dict[str, frozenset[str]]' = dict()
+# Platform name -> list of (full group, group id without platform prefix)
+_platform_groups: 'dict[str, list[tuple[str, str]]]' = defaultdict(list)
 
-async def get_bridge_map():
-    bridge_cfg: 'list[list[str]]' = await config.get('Bridge', default=[])
-    bridge_map: 'dict[str, list[str]]' = dict()
+# Platform name -> ids of groups with connected groups, as ints for telegram and discord
+_bridge_ids: 'dict[str, frozenset]' = dict()
+
+def _parse_group_id(platform: str, group_id: str):
+    """
+    Convert the group id to the type used by the platform library.
+    """
+    if platform in {'telegram', 'discord'}:
+        try:
+            return int(group_id)
+        except ValueError:
+            logger.warning(f'invalid group id in config: {platform}/{group_id}')
+    return group_id
+
+def _build_bridge_indexes(bridge_cfg: 'list[list[str]]'):
+    global _bridge_cfg, _bridge_map, _outbound_groups, _platform_groups, _bridge_ids
+    # Interned keys are hashed and compared faster with keys from group_key()
+    orig_bridge_cfg, bridge_cfg = bridge_cfg, [[sys.intern(group) for group in groups] for groups in bridge_cfg]
+    bridge_map: 'dict[str, list[tuple[str, str, int | str]]]' = dict()
+    # Split and parse each group only once here instead of on every message
+    split_groups = {group: tuple(group.split('/', 1)) for groups in bridge_cfg for group in groups}
+    parsed_groups = {group: (platform, _parse_group_id(platform, group_id)) for group, (platform, group_id) in split_groups.items()}
     for groups in bridge_cfg:
         for group in groups:
             if group in bridge_map:
                 logger.warning(f'duplicate mapping in config: {group} - previous mapping will be overwritten')
             # Map each group with other connected groups
-            bridge_map[group] = [g for g in groups if g != group]
-    return bridge_map
+            bridge_map[group] = [(g, *parsed_groups[g]) for g in groups if g != group]
+    outbound_groups = {group: frozenset(g for g, _, _ in targets) for group, targets in bridge_map.items()}
+    platform_groups: 'dict[str, list[tuple[str, str]]]' = defaultdict(list)
+    for group in bridge_map:
+        platform, group_id = split_groups[group]
+        platform_groups[platform].append((group, group_id))
+    bridge_ids = {
+        platform: frozenset(parsed_groups[group][1] for group, _ in groups if bridge_map[group])
+        for platform, groups in platform_groups.items()
+    }
+    _bridge_cfg, _bridge_map, _outbound_groups = orig_bridge_cfg, bridge_map, outbound_groups
+    _platform_groups, _bridge_ids = platform_groups, bridge_ids
+
+def get_bridge_map_nowait() -> 'dict[str, list[tuple[str, str, int | str]]]':
+    """
+    Return the map of each group to its connected groups, as (group, platform, group id) tuples.
+    Group ids are ints for telegram and discord, as used by their libraries.
+    Not a coroutine, so listeners check groups without awaiting; config changes are loaded by watch_config().
+    """
+    bridge_cfg: 'list[list[str]]' = config.get_nowait('Bridge', default=[])
+    # Only rebuild when the config is (re)loaded, which replaces the list object
+    if bridge_cfg is not _bridge_cfg:
+        _build_bridge_indexes(bridge_cfg)
+    return _bridge_map
+
+def get_outbound_groups_nowait(group: str) -> 'frozenset[str]':
+    """
+    Return the groups connected with the given group, i.e. where its messages are relayed to.
+    """
+    get_bridge_map_nowait()
+    return _outbound_groups.get(group, frozenset())
+
+def get_platform_groups_nowait(platform: str) -> 'list[tuple[str, str]]':
+    """
+    Return all groups of the given platform as a list of (full group, group id without platform prefix)
+    """
+    get_bridge_map_nowait()
+    return _platform_groups.get(platform.lower(), [])
+
+def get_bridge_ids_nowait(platform: str) -> frozenset:
+    """
+    Return ids of groups of the given platform that have connected groups, without platform prefix.
+    Ids are ints for telegram and discord, so they can be compared with ids from events directly.
+    """
+    get_bridge_map_nowait()
+    return _bridge_ids.get(platform, frozenset())
 
 async def get_groups(platform: str):
     """
     Generate all group ids of the given platform, without platform prefix
     """
-    for group in (await get_bridge_map()).keys():
-        if group.startswith(platform.lower()):
-            yield group.split('/', 1)[1]
+    for _, group_id in get_platform_groups_nowait(platform):
+        yield group_id
+
+# Seconds between two checks of the config file
+CONFIG_WATCH_INTERVAL = 5
+# Set when the config file is reloaded, cleared by the waiter
+reload_event = asyncio.Event()
+
+async def watch_config():
+    """
+    Background task reloading the config when the file is modified, so Bridge changes apply without restart.
+    """
+    while True:
+        await asyncio.sleep(CONFIG_WATCH_INTERVAL)
+        if await config.reload_if_changed():
+            logger.info('Config file changed and was reloaded')
+            reload_event.set()
+
+@functools.lru_cache(maxsize=4096)
+def group_key(platform: str, group_id) -> str:
+    """
+    Return the full group name used in config and database, e.g. telegram/-100123456789.
+    Cached so that keys of active groups are not rebuilt for every message.
+    """
+    return sys.intern(f'{platform}/{group_id}')
+
+# Coarse current time, updated by clock() so hot paths do not build a new datetime on every message
+CLOCK_RESOLUTION = 0.1
+_now: 'datetime | None' = None
+
+def utcnow() -> datetime:
+    """
+    Return the current UTC time with CLOCK_RESOLUTION precision.
+    Falls back to the exact time if clock() is not running.
+    """
+    return _now or datetime.now(timezone.utc)
+
+async def clock():
+    """
+    Background task updating the time returned by utcnow().
+    """
+    global _now
+    while True:
+        _now = datetime.now(timezone.utc)
+        await asyncio.sleep(CLOCK_RESOLUTION)
 
 def normurl(url: str) -> str:
     """
@@ -1,7 +1,17 @@
 import asyncio
 import discord
+import functools
 import logging
+import logging.handlers
 import os
+import queue
+try:
+    # uvloop is faster than the default event loop, but not available on Windows.
+    # It must be installed before any bot module creates asyncio objects or clients
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 import bot.utils as utils
 from bot.config import Config
 from bot.database import MongoDB
@@ -9,19 +19,23 @@ from bot.discordbot import Discord
 from bot.filter import Filter
 from bot.irc import IRC
 from bot.message import get_relay_message, get_deleted_message, get_edited_message
-from bot.telegram import Telegram
+from bot.telegram import Telegram, retry_on_flood_wait
+from collections import defaultdict
+from datetime import timedelta
 from telethon import errors
 from uuid import uuid4
 
 # Load configs from file
 config = Config('bridge.yaml')
 
-logging.basicConfig(
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    filename=config.get_nowait('Logging', 'path', default=''),
-    filemode='w'
-)
+# Log records are only put into a queue in the event loop, and written to file by a background thread
+log_path = config.get_nowait('Logging', 'path', default='')
+log_handler = logging.FileHandler(log_path, mode='w') if log_path else logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)])
+log_listener.start()
 logger = logging.getLogger(__name__)
 try:
     logger.setLevel(config.get_nowait('Logging', 'level', default='INFO'))
@@ -31,6 +45,11 @@ except ValueError:
 
 # Initialize shared bridge objects
 message_queue = utils.message_queue
+# Locks to process messages from the same group in order
+group_locks: 'dict[str, asyncio.Lock]' = defaultdict(asyncio.Lock)
+# Limit concurrent sends to the same group from different source groups, to stay below rate limits
+MAX_SENDS_PER_GROUP = config.get_nowait('Worker', 'max_sends_per_group', default=5)
+send_semaphores: 'dict[str, asyncio.Semaphore]' = defaultdict(lambda: asyncio.Semaphore(MAX_SENDS_PER_GROUP))
 
 # IRC bot initialization
 irc = IRC()
@@ -49,6 +68,8 @@ db = MongoDB()
 msg_collection = db.collection
 
 filter = Filter()
+# IRC settings used for every relayed message, read once at startup
+IRC_MAX_LINES = config.get_nowait('IRC', 'max_lines')
 
 async def send_irc_message(group_id: str, text: str) -> str:
     """
@@ -56,7 +77,7 @@ async def send_irc_message(group_id: str, text: str) -> str:
 
     Returns truncated text with a url to pastebin, or the original text
     """
-    max_lines = await config.get('IRC', 'max_lines')
+    max_lines = IRC_MAX_LINES
     lines = text.split('\n')
     if len(lines) > max_lines:
         if await config.get('IRC', 'upload_long_msg'):
@@ -83,276 +104,449 @@ async def send_irc_message(group_id: str, text: str) -> str:
         await irc_bot.message(group_id, text)
     return text
 
-async def worker():
+def get_reply_to_id(message, group_to_send: str):
     """
-    The consumer will fetch messages from queue, insert into database and
-    relay the message to other platform.
+    Get the message id to reply to on the platform and group to send.
     """
-    while True:
-        message = await message_queue.get()
-        if type(message) is dict:
-            # internal message, indicates to delete or update existing messages
-            logger.info(f'internal message: {message}')
-            action = message.get('action')
-            if action == 'delete':
-                # List of msg_doc dicts
-                old_messages = message.get('body', {})
-                if type(old_messages) is not list: old_messages = [old_messages]
-                irc_groups_notified = set()
-                for old_message in old_messages:
-                    for to_delete in old_message.get('bridge_messages', []):
-                        group_to_delete, id_to_delete = to_delete.get('group', ''), to_delete.get('message_id')
-                        platform, group_id = group_to_delete.split('/', 1)
-                        if platform == 'irc':
-                            # Send a message to inform users of the delete, but only once for bulk deletion
-                            if group_id in irc_groups_notified: continue
-                            await irc_bot.message(group_id, await get_deleted_message(old_messages))
-                            irc_groups_notified.add(group_id)
-                        elif platform == 'telegram':
-                            # Delete all messages at the same time
-                            try:
-                                await tg_bot.delete_messages(int(group_id), [id_to_delete])
-                            except (errors.ChannelInvalidError, errors.ChannelPrivateError, errors.MessageDeleteForbiddenError) as e:
-                                logger.warning(f'Telegram error occured on deleting message {id_to_delete} in {group_id}: {e}')
-                            except Exception as e:
-                                # TODO: probably catch errors.FloodWaitError
-                                logger.warning(f'Unknown error occured on deleting message {id_to_delete} in {group_id}: {e}')
-                        elif platform == 'discord':
-                            # Have to delete messages one by one
-                            try:
-                                channel = dc_bot.get_channel(int(group_id))
-                                if not channel:
-                                    logger.warning(f'Discord error occured on deleting message {id_to_delete} in {group_id}: channel not found')
-                                    continue
-                                msg = await channel.fetch_message(id_to_delete)
-                                await msg.delete()
-                            except discord.errors.DiscordException as e:
-                                logger.warning(f'Discord error occured on deleting message {id_to_delete} in {group_id}: {e}')
-                            except Exception as e:
-                                logger.warning(f'Unknown error occured on deleting message {id_to_delete} in {group_id}: {e}')
-                        else:
-                            logger.warning(f'Unknown platform: {platform} (from {message}), please report this bug')
-            elif action == 'edit':
-                new_message = message.get('body', {}).get('new_message')  # Message
-                groups_edited = set()
-                old_message = message.get('body', {}).get('to_edit', {})  # dict
-                relay_message_text_irc = ''
-                for to_edit in old_message.get('bridge_messages', {}):
-                    group_to_edit, id_to_edit = to_edit.get('group', ''), to_edit.get('message_id')
-                    # Check if the edited message should be filtered
-                    if await filter.test(new_message, group_to_edit):
-                        logger.info(f'The message is blocked from editing at {group_to_edit}')
-                        continue
-                    platform, group_id = group_to_edit.split('/', 1)
-                    relay_message_text = await get_relay_message(new_message, platform)
+    if message.reply_to:
+        for replied_msg in message.reply_to.get('bridge_messages', []):
+            if replied_msg.get('group') == group_to_send:
+                return replied_msg.get('message_id')
+    return None
+
+async def relay_to_irc(message, groups: 'list[tuple[str, str]]') -> list[dict]:
+    """
+    Relay the message to given IRC channels, (group, channel name) pairs, one by one.
+
+    Returns the bridge_messages entries of sent messages.
+    """
+    ret = []
+    relay_message_text_irc = await get_relay_message(message, 'irc')
+    for group_to_send, group_id in groups:
+        # Update relay_message_text_irc, so other IRC channels do not need to upload again
+        relay_message_text_irc = await send_irc_message(group_id, relay_message_text_irc)
+        ret.append({
+            'group': group_to_send,
+            # IRC messages have no IDs
+            'message_id': None,
+        })
+        logger.info('sent message to %s', group_to_send)
+    return ret
+
+async def relay_to_telegram(message, group_to_send: str, group_id: int, relay_message_text: str) -> list[dict]:
+    """
+    Relay the message to a Telegram group.
+
+    Returns the bridge_messages entries of sent messages.
+    """
+    reply_to_id = get_reply_to_id(message, group_to_send)
+    sent = []
+    # Group ids from the bridge map are already ints, as Telethon requires
+    if message.files:
+        # TODO: how to deal with captions of each photo in album?
+        image_files, plain_files, named_files = tg.construct_files(message.files)
+        # If the message was downloaded as a document, then upload as document as well
+        force_document = (message.files[0].type == 'document')
+        # Send album or single photo
+        if image_files:
+            try:
+                sent = await retry_on_flood_wait(lambda: tg_bot.send_file(
+                    group_id, image_files, caption=relay_message_text,
+                    force_document=force_document, reply_to=reply_to_id))
+            except Exception as e:
+                logger.warning(f'Cannot send Telegram message to {group_id}: {e}')
+        # For albums, return will be a list, so just convert all cases to list for convenience
+        if type(sent) is not list:
+            sent = [sent]
+        # For messages after the first: reply to the first, and shall not include texts
+        first_msg = sent[0] if sent else None
+        if plain_files:
+            # Files without a filename to override are sent together as an album
+            try:
+                result = await retry_on_flood_wait(lambda: tg_bot.send_file(
+                    group_id, plain_files, caption=('' if first_msg else relay_message_text),
+                    reply_to=first_msg, force_document=force_document))
+                sent.extend(result if type(result) is list else [result])
+            except Exception as e:
+                # e.g. audio files cannot be grouped with other documents, send them one by one instead
+                logger.info('Cannot send Telegram files to %s as an album, sending one by one: %s', group_id, e)
+                named_files = [(path, None) for path in plain_files] + named_files
+            if not first_msg and sent:
+                first_msg = sent[0]
+        # Can only send one message per time, with filename overridden
+        for path, attr in named_files:
+            try:
+                sent.append(await retry_on_flood_wait(lambda: tg_bot.send_file(
+                    group_id, path, caption=('' if first_msg else relay_message_text),
+                    attributes=([attr] if attr else None), reply_to=first_msg, force_document=force_document)))
+            except Exception as e:
+                logger.warning(f'Cannot send Telegram file to {group_id}: {e}')
+            if not first_msg and sent:
+                first_msg = sent[-1]
+    else:
+        try:
+            sent = [await retry_on_flood_wait(lambda: tg_bot.send_message(
+                group_id, relay_message_text, parse_mode='md', reply_to=reply_to_id))]
+        except Exception as e:
+            logger.warning(f'Cannot send Telegram message to {group_id}: {e}')
+    logger.info('sent message to %s, msg ids = %s', group_to_send, [sent_msg.id for sent_msg in sent])
+    return [{
+        'group': group_to_send,
+        'message_id': sent_msg.id,
+    } for sent_msg in sent]
+
+async def relay_to_discord(message, group_to_send: str, group_id: int, relay_message_text: str,
+                           file_data: 'dict[str, bytes]'=None) -> list[dict]:
+    """
+    Relay the message to a Discord channel.
+
+    file_data: contents of message files if already read, see Discord.read_files()
+
+    Returns the bridge_messages entries of sent messages.
+    """
+    # Group ids from the bridge map are already ints
+    channel = dc.get_channel(group_id)
+    if not channel:
+        logger.warning(f'Discord error occured on sending message to {group_id}: channel not found')
+        return []
+    reply_to_id = get_reply_to_id(message, group_to_send)
+    try:
+        if reply_to_id:
+            sent = await channel.send(relay_message_text, files=dc.construct_files(message.files, file_data),
+                                      reference=channel.get_partial_message(reply_to_id))
+        else:
+            sent = await channel.send(relay_message_text, files=dc.construct_files(message.files, file_data))
+    except discord.errors.Forbidden:
+        logger.warning(f'Cannot send Discord message to {group_id}: access denied')
+        return []
+    except Exception as e:
+        logger.warning(f'Cannot send Discord message to {group_id}: {e}')
+        return []
+    logger.info('sent message to %s, msg id = %s', group_to_send, sent.id)
+    return [{
+        'group': group_to_send,
+        'message_id': sent.id,
+    }]
+
+async def delete_discord_messages(group_id: str, ids_to_delete: list[int]):
+    """
+    Delete messages in a Discord channel, with bulk delete requests if possible.
+    """
+    channel = dc.get_channel(int(group_id))
+    if not channel:
+        logger.warning('Discord error occured on deleting messages %s in %s: channel not found', ids_to_delete, group_id)
+        return
+    # Bulk delete rejects messages older than 14 days, so delete those one by one without trying
+    bulk_after = utils.utcnow() - timedelta(days=14) + timedelta(minutes=1)
+    old_ids = [i for i in ids_to_delete if discord.utils.snowflake_time(i) < bulk_after]
+    new_ids = [i for i in ids_to_delete if discord.utils.snowflake_time(i) >= bulk_after]
+    # Discord allows bulk deleting up to 100 messages per request
+    for start in range(0, len(new_ids), 100):
+        chunk = new_ids[start:start+100]
+        try:
+            await channel.delete_messages([discord.Object(id=id_to_delete) for id_to_delete in chunk])
+            continue
+        except discord.errors.DiscordException as e:
+            # Bulk delete needs the manage messages permission
+            logger.info('Discord bulk delete of %s in %s failed, deleting one by one: %s', chunk, group_id, e)
+        old_ids.extend(chunk)
+    for id_to_delete in old_ids:
+        try:
+            # Partial messages are deleted without fetching them first
+            await channel.get_partial_message(id_to_delete).delete()
+        except discord.errors.DiscordException as e:
+            logger.warning('Discord error occured on deleting message %s in %s: %s', id_to_delete, group_id, e)
+        except Exception as e:
+            logger.warning('Unknown error occured on deleting message %s in %s: %s', id_to_delete, group_id, e)
+
+async def notify_irc_edit(old_message: dict, new_message, group_ids: list[str]):
+    """
+    Send a message to inform users of the edit in given IRC channels.
+    """
+    relay_message_text_irc = await get_edited_message(old_message, new_message)
+    for group_id in group_ids:
+        # Use cached message returned by send_irc_message (possibly truncated)
+        relay_message_text_irc = await send_irc_message(group_id, relay_message_text_irc)
+
+async def edit_telegram_message(new_message, group_id: str, id_to_edit: int, relay_message_text: str):
+    """
+    Edit a relayed message in a Telegram group.
+    """
+    try:
+        image_files, plain_files, named_files = tg.construct_files(new_message.files)
+        # Workaround: a message can only be edited to have one media, so keep the first one with its own filename
+        file, attributes = None, None
+        if image_files:
+            file = image_files[0]
+        elif plain_files:
+            file = plain_files[0]
+        elif named_files:
+            file, attr = named_files[0]
+            attributes = [attr]
+        await retry_on_flood_wait(lambda: tg_bot.edit_message(
+            int(group_id), id_to_edit, relay_message_text, file=file, attributes=attributes,
+            force_document=bool(new_message.files) and new_message.files[0].type == 'document'))
+    except errors.RPCError as e:
+        # Including FloodWaitError after all retries
+        logger.warning(f'Telegram error occured on editing messages {id_to_edit} in {group_id}: {e}')
+    except Exception as e:
+        logger.warning(f'Unknown error occured on editing messages {id_to_edit} in {group_id}: {e}')
+
+async def edit_discord_message(new_message, group_id: str, id_to_edit: int, relay_message_text: str):
+    """
+    Edit a relayed message in a Discord channel.
+    """
+    try:
+        channel = dc.get_channel(int(group_id))
+        if not channel:
+            logger.warning(f'Discord error occured on editing message {id_to_edit} in {group_id}: channel not found')
+            return
+        # Partial messages are edited without fetching them first
+        await channel.get_partial_message(id_to_edit).edit(content=relay_message_text,
+                                                           attachments=dc.construct_files(new_message.files))
+    except discord.errors.DiscordException as e:
+        logger.warning(f'Discord error occured on editing message {id_to_edit} in {group_id}: {e}')
+    except Exception as e:
+        logger.warning(f'Unknown error occured on editing message {id_to_edit} in {group_id}: {e}')
+
+async def relay_limited(relay_fn, message, group_to_send: str, group_id: int, relay_message_text: str) -> list[dict]:
+    """
+    Call relay_fn to relay the message to a group, waiting if too many messages are being sent to the group.
+    """
+    async with send_semaphores[group_to_send]:
+        return await relay_fn(message, group_to_send, group_id, relay_message_text)
+
+# Per-platform send and edit functions. IRC is not listed since its channels are sent together with one message
+RELAY_FNS = {
+    'telegram': relay_to_telegram,
+    'discord': relay_to_discord,
+}
+EDIT_FNS = {
+    'telegram': edit_telegram_message,
+    'discord': edit_discord_message,
+}
+
+async def process_message(message):
+    """
+    Insert a message from the queue into database and relay it to other platforms,
+    or handle internal messages of listeners.
+    """
+    if type(message) is dict:
+        # internal message, indicates to delete or update existing messages
+        logger.info('internal message: %s', message)
+        action = message.get('action')
+        if action == 'delete':
+            # List of msg_doc dicts
+            old_messages = message.get('body', {})
+            if type(old_messages) is not list: old_messages = [old_messages]
+            irc_groups_notified = set()
+            tg_to_delete: 'dict[str, list[int]]' = defaultdict(list)
+            dc_to_delete: 'dict[str, list[int]]' = defaultdict(list)
+            for old_message in old_messages:
+                for to_delete in old_message.get('bridge_messages', []):
+                    group_to_delete, id_to_delete = to_delete.get('group', ''), to_delete.get('message_id')
+                    platform, group_id = group_to_delete.split('/', 1)
                     if platform == 'irc':
-                        # Workaround to https://github.com/LonamiWebs/Telethon/issues/4093
-                        # Telegram will send the first reaction as a MessageEdited event
-                        # and it's INDISTINGUISHABLE from normal edit events
-                        if old_message.get('text') == new_message.text:
-                            continue
-                        # Send a message to inform users of the edit
-                        if relay_message_text_irc:
-                            # Use cached message returned by send_irc_message (possibly truncated)
-                            relay_message_text_irc = await send_irc_message(group_id, relay_message_text_irc)
-                        else:
-                            relay_message_text_irc = await send_irc_message(group_id, await get_edited_message(old_message, new_message))
+                        # Send a message to inform users of the delete, but only once for bulk deletion
+                        if group_id in irc_groups_notified: continue
+                        await irc_bot.message(group_id, await get_deleted_message(old_messages))
+                        irc_groups_notified.add(group_id)
                     elif platform == 'telegram':
-                        # Workaround: deal with the first message in each group only
-                        # TODO: find a better solution for edge cases
-                        if group_to_edit in groups_edited: continue
-                        try:
-                            image_files, other_files, attrs = tg.construct_files(new_message.files)
-                            # Workaround: first media only
-                            image_files, other_files, attrs = image_files[:1], other_files[:1], attrs[:1]
-                            await tg_bot.edit_message(int(group_id), id_to_edit, relay_message_text,
-                                                      file=(image_files or other_files), attributes=attrs,
-                                                      force_document=(new_message.files and new_message.files[0].type == 'document'))
-                        except errors.RPCError as e:
-                            logger.warning(f'Telegram error occured on editing messages {id_to_edit} in {group_id}: {e}')
-                        except Exception as e:
-                            # TODO: probably catch errors.FloodWaitError
-                            logger.warning(f'Unknown error occured on editing messages {id_to_edit} in {group_id}: {e}')
+                        # Collect messages to delete them at the same time
+                        tg_to_delete[group_id].append(id_to_delete)
                     elif platform == 'discord':
-                        try:
-                            channel = dc_bot.get_channel(int(group_id))
-                            if not channel:
-                                logger.warning(f'Discord error occured on editing message {id_to_delete} in {group_id}: channel not found')
-                                continue
-                            msg = await channel.fetch_message(id_to_edit)
-                            await msg.edit(content=relay_message_text, attachments=dc.construct_files(new_message.files))
-                        except discord.errors.DiscordException as e:
-                            logger.warning(f'Discord error occured on editing message {id_to_edit} in {group_id}: {e}')
-                        except Exception as e:
-                            logger.warning(f'Unknown error occured on editing message {id_to_edit} in {group_id}: {e}')
+                        dc_to_delete[group_id].append(id_to_delete)
                     else:
                         logger.warning(f'Unknown platform: {platform} (from {message}), please report this bug')
-                    groups_edited.add(group_to_edit)
-            elif action == 'ircnames':
-                # `event` is event in telethon or ctx in discord. Will be called as `event.reply(message)`.
-                target, event, from_group = message.get('target'), message.get('event'), message.get('from_group')
-                response = []
-                # Get all connected IRC channels
-                for group in (await utils.get_bridge_map()).get(from_group, []):
-                    platform, group_id = group.split('/', 1)
-                    if platform != 'irc':
-                        continue
-                    users = irc_bot.channels[group_id]['users']
-                    if target:
-                        response.append(f'{target} 在 {group_id} 频道' if target in users else f'{target} 不在 {group_id} 频道')
-                    else:
-                        response.append(f'{group_id} 中的用户: {", ".join(users)}')
+            # Delete all messages in each telegram group with one request
+            for group_id, ids_to_delete in tg_to_delete.items():
+                try:
+                    await retry_on_flood_wait(lambda: tg_bot.delete_messages(int(group_id), ids_to_delete))
+                except (errors.ChannelInvalidError, errors.ChannelPrivateError, errors.MessageDeleteForbiddenError,
+                        errors.FloodWaitError) as e:
+                    logger.warning(f'Telegram error occured on deleting messages {ids_to_delete} in {group_id}: {e}')
+                except Exception as e:
+                    logger.warning(f'Unknown error occured on deleting messages {ids_to_delete} in {group_id}: {e}')
+            for group_id, ids_to_delete in dc_to_delete.items():
+                await delete_discord_messages(group_id, ids_to_delete)
+        elif action == 'edit':
+            body = message.get('body', {})
+            new_message = body.get('new_message')  # Message
+            groups_edited = set()
+            old_message = body.get('to_edit', {})  # dict
+            # Workaround to https://github.com/LonamiWebs/Telethon/issues/4093
+            # Telegram will send the first reaction as a MessageEdited event
+            # and it's INDISTINGUISHABLE from normal edit events
+            text_edited = old_message.get('text') != new_message.text
+            tasks = []
+            irc_groups = []
+            # Relayed text is the same for all groups on the same platform
+            relay_message_texts = {}
+            for to_edit in old_message.get('bridge_messages', {}):
+                group_to_edit, id_to_edit = to_edit.get('group', ''), to_edit.get('message_id')
+                # Check if the edited message should be filtered
+                if await filter.test(new_message, group_to_edit):
+                    logger.info('The message is blocked from editing at %s', group_to_edit)
+                    continue
+                platform, group_id = group_to_edit.split('/', 1)
+                if platform == 'irc':
+                    if text_edited:
+                        irc_groups.append(group_id)
+                    continue
+                edit = EDIT_FNS.get(platform)
+                if not edit:
+                    logger.warning(f'Unknown platform: {platform} (from {message}), please report this bug')
+                    continue
+                # Workaround: deal with the first message in each telegram group only
+                # TODO: find a better solution for edge cases
+                if platform == 'telegram' and group_to_edit in groups_edited: continue
+                groups_edited.add(group_to_edit)
+                if platform not in relay_message_texts:
+                    relay_message_texts[platform] = await get_relay_message(new_message, platform)
+                tasks.append(edit(new_message, group_id, id_to_edit, relay_message_texts[platform]))
+            if irc_groups:
+                tasks.append(notify_irc_edit(old_message, new_message, irc_groups))
 
-                if response:
-                    response = '\n'.join(response)
-                    if type(event) is discord.Interaction:
-                        await event.response.send_message(response)
-                    else:
-                        await event.reply(response)
-            elif action == 'ircwhois' or action == 'ircwhowas':
-                target, event, from_group = message.get('target'), message.get('event'), message.get('from_group')
-                response = []
-                # Must have a connected IRC channel to use whois/whowas
-                for group in (await utils.get_bridge_map()).get(from_group, []):
-                    platform, group_id = group.split('/', 1)
-                    if platform == 'irc':
-                        break
-                else:
+            # Edit in all groups concurrently
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, Exception):
+                    logger.warning(f'Unknown error occured on editing message {old_message}: {result}')
+        elif action == 'ircnames':
+            # `event` is event in telethon or ctx in discord. Will be called as `event.reply(message)`.
+            target, event, from_group = message.get('target'), message.get('event'), message.get('from_group')
+            response = []
+            # Get all connected IRC channels
+            for _, platform, group_id in utils.get_bridge_map_nowait().get(from_group, []):
+                if platform != 'irc':
                     continue
+                users = irc_bot.channels[group_id]['users']
+                if target:
+                    response.append(f'{target} 在 {group_id} 频道' if target in users else f'{target} 不在 {group_id} 频道')
+                else:
+                    response.append(f'{group_id} 中的用户: {", ".join(users)}')
 
-                response = (await irc_bot.my_whois(target)) if action == 'ircwhois' else (await irc_bot.my_whowas(target))
-                response = f'`{response}`'  # Send as inline code to avoid parse errors from Telethon
+            if response:
+                response = '\n'.join(response)
                 if type(event) is discord.Interaction:
                     await event.response.send_message(response)
                 else:
                     await event.reply(response)
+        elif action == 'ircwhois' or action == 'ircwhowas':
+            target, event, from_group = message.get('target'), message.get('event'), message.get('from_group')
+            response = []
+            # Must have a connected IRC channel to use whois/whowas
+            for _, platform, _ in utils.get_bridge_map_nowait().get(from_group, []):
+                if platform == 'irc':
+                    break
             else:
-                logger.warning(f'Unknown action {action} from message of a listener: {message}')
-            continue
-        logger.info(f'outgoing message: ' + str(message))
-        logger.info(f'outgoing message reply to: ' + str(message.reply_to))
-        # The first item of the list in MongoDB is always the original message ('from'), others are 'to'
-        bridge_messages = [{
-            'group': message.from_group,
-            'message_id': message.from_message_id,
-        }]
-        relay_message_text_irc = ''
-        for group_to_send in (await utils.get_bridge_map()).get(message.from_group, []):
-            # Check if the message should be filtered
-            if await filter.test(message, group_to_send):
-                logger.info(f'The message is blocked from sending to {group_to_send}')
-                continue
-            # TODO: make this a helper function
-            platform, group_id = group_to_send.split('/', 1)
-            relay_message_text = await get_relay_message(message, platform)
-            # Get the message id to reply to on this platform and group
-            reply_to_id = None
-            if message.reply_to:
-                for replied_msg in message.reply_to.get('bridge_messages', []):
-                    if replied_msg.get('group') == group_to_send:
-                        reply_to_id = replied_msg.get('message_id')
-                        break
-            if platform == 'irc':
-                # Update relay_message_text_irc, so other IRC channels do not need to upload again
-                relay_message_text_irc = await send_irc_message(group_id, relay_message_text_irc if relay_message_text_irc else relay_message_text)
-                bridge_messages.append({
-                    'group': group_to_send,
-                    # IRC messages have no IDs
-                    'message_id': None,
-                })
-                logger.info(f'sent message to {group_to_send}')
-            elif platform == 'telegram':
-                # Telethon only accept int group ids
-                if message.files:
-                    # TODO: how to deal with captions of each photo in album?
-                    image_files, other_files, attrs = tg.construct_files(message.files)
-                    sent = []
-                    # Send album or single photo
-                    if image_files:
-                        try:
-                            sent = await tg_bot.send_file(int(group_id), image_files, caption=relay_message_text,
-                                                          # If the message was downloaded as a document, then upload as document as well
-                                                          force_document=(message.files[0].type == 'document'), reply_to=reply_to_id)
-                        except Exception as e:
-                            logger.warning(f'Cannot send Telegram message to {group_id}: {e}')
-                    # For messages after the first: reply to the first, and shall not include texts
-                    first_msg = sent or None
-                    if type(first_msg) is list: first_msg = first_msg[0]
-                    if other_files:
-                        # Can only send one message per time, with filename overridden
-                        for i, file in enumerate(other_files):
-                            try:
-                                sent.append(await tg_bot.send_file(int(group_id), file, caption=('' if first_msg else relay_message_text),
-                                                                   attributes=[attrs[i]], reply_to=first_msg,
-                                                                   # If the message was downloaded as a document, then upload as document as well
-                                                                   force_document=(message.files[0].type == 'document')))
-                            except Exception as e:
-                                logger.warning(f'Cannot send Telegram file to {group_id}: {e}')
-                            if not first_msg and sent:
-                                first_msg = sent[-1]
-                else:
-                    try:
-                        sent = await tg_bot.send_message(int(group_id), relay_message_text, parse_mode='md', reply_to=reply_to_id)
-                    except Exception as e:
-                        logger.warning(f'Cannot send Telegram message to {group_id}: {e}')
-                # For albums, return will be a list, so just convert all cases to list for convenience
-                if type(sent) is not list:
-                    sent = [sent]
-                bridge_messages.extend([{
-                    'group': group_to_send,
-                    'message_id': sent_msg.id,
-                } for sent_msg in sent])
-                logger.info(f'sent message to {group_to_send}, msg ids = {[sent_msg.id for sent_msg in sent]}')
-            elif platform == 'discord':
-                # Discord only accept int group ids
-                channel = dc_bot.get_channel(int(group_id))
-                if not channel:
-                    logger.warning(f'Discord error occured on sending message to {group_id}: channel not found')
-                    continue
-                try:
-                    if reply_to_id:
-                        sent = await channel.send(relay_message_text, files=dc.construct_files(message.files), reference=channel.get_partial_message(reply_to_id))
-                    else:
-                        sent = await channel.send(relay_message_text, files=dc.construct_files(message.files))
-                except discord.errors.Forbidden:
-                    logger.warning(f'Cannot send Discord message to {group_id}: access denied')
-                except Exception as e:
-                    logger.warning(f'Cannot send Discord message to {group_id}: {e}')
-                bridge_messages.append({
-                    'group': group_to_send,
-                    'message_id': sent.id,
-                })
-                logger.info(f'sent message to {group_to_send}, msg id = {sent.id}')
+                return
+
+            response = (await irc_bot.my_whois(target)) if action == 'ircwhois' else (await irc_bot.my_whowas(target))
+            response = f'`{response}`'  # Send as inline code to avoid parse errors from Telethon
+            if type(event) is discord.Interaction:
+                await event.response.send_message(response)
             else:
-                # Unknown platform
-                bridge_messages.append({
-                    'group': None,
-                    'message_id': None,
-                })
-                logger.warning(f'Unknown platform: {platform} (from {group_to_send}), check your Bridge config')
-
-        await msg_collection.insert_one({
-            'system': message.system,
-            'deleted': False,
-            'created_at': message.created_at,
-            'edited_at': None,
-            'deleted_at': None,
-            'bridge_messages': bridge_messages,
-            'from_user_id': message.from_user_id,
-            'from_nick': message.from_nick,
-            'text': message.text,
-            # Convert File object to dict
-            'files': [vars(file) for file in message.files],
-            'fwd_from': message.fwd_from,
-            'reply_to': message.reply_to.get('_id') if message.reply_to else None,
-        })
+                await event.reply(response)
+        else:
+            logger.warning(f'Unknown action {action} from message of a listener: {message}')
+        return
+    logger.info('outgoing message: %s', message)
+    logger.info('outgoing message reply to: %s', message.reply_to)
+    # The first item of the list in MongoDB is always the original message ('from'), others are 'to'
+    bridge_messages = [{
+        'group': message.from_group,
+        'message_id': message.from_message_id,
+    }]
+    tasks = []
+    irc_groups = []
+    # Relayed text is the same for all groups on the same platform
+    relay_message_texts = {}
+    destinations = utils.get_bridge_map_nowait().get(message.from_group, [])
+    relay_fns = RELAY_FNS
+    if message.files and sum(platform == 'discord' for _, platform, _ in destinations) > 1:
+        # Read files once for all discord channels, instead of once per channel
+        file_data = await dc.read_files(message.files)
+        relay_fns = {**RELAY_FNS, 'discord': functools.partial(relay_to_discord, file_data=file_data)}
+    for group_to_send, platform, group_id in destinations:
+        # Check if the message should be filtered
+        if await filter.test(message, group_to_send):
+            logger.info('The message is blocked from sending to %s', group_to_send)
+            continue
+        if platform == 'irc':
+            # IRC channels are sent together, see relay_to_irc()
+            irc_groups.append((group_to_send, group_id))
+        elif platform in relay_fns:
+            if platform not in relay_message_texts:
+                relay_message_texts[platform] = await get_relay_message(message, platform)
+            tasks.append(relay_limited(relay_fns[platform], message, group_to_send, group_id, relay_message_texts[platform]))
+        else:
+            # Unknown platform
+            bridge_messages.append({
+                'group': None,
+                'message_id': None,
+            })
+            logger.warning(f'Unknown platform: {platform} (from {group_to_send}), check your Bridge config')
+    if irc_groups:
+        tasks.append(relay_to_irc(message, irc_groups))
+
+    # Send to all groups concurrently
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.warning(f'Unknown error occured on relaying message {message}: {result}')
+            continue
+        bridge_messages.extend(result)
+    # Let the deleted poller know new telegram messages
+    tg.track_messages(bridge_messages)
+
+    if message.system and all(m.get('message_id') is None for m in bridge_messages):
+        # IRC-only system messages (join, quit, nick...) can never be edited, deleted or replied,
+        # and are not used to find active users, so there is nothing to store.
+        # Non-system IRC messages are still stored for get_active_groups_on_platform()
+        return
+    db.insert_message({
+        'system': message.system,
+        'deleted': False,
+        'created_at': message.created_at,
+        'edited_at': None,
+        'deleted_at': None,
+        'bridge_messages': bridge_messages,
+        'from_user_id': message.from_user_id,
+        'from_nick': message.from_nick,
+        'text': message.text,
+        'files': [file.to_doc() for file in message.files],
+        'fwd_from': message.fwd_from,
+        'reply_to': message.reply_to.get('_id') if message.reply_to else None,
+    })
+
+async def worker():
+    """
+    The consumer will fetch messages from queue and process them.
+    Several workers run concurrently, but messages from the same group are processed in order.
+    """
+    while True:
+        message = await message_queue.get()
+        # Internal messages without a source group are not ordered
+        from_group = message.get('from_group') if type(message) is dict else message.from_group
+        if not from_group:
+            await process_message(message)
+            continue
+        async with group_locks[from_group]:
+            await process_message(message)
 
 async def main():
+    # uvloop is installed at the top of this file if available
+    logger.info(f'Running on event loop {type(asyncio.get_running_loop())}')
+    # Open connections before the first message arrives
+    await db.client.admin.command('ping')
+    await db.create_indexes()
     await asyncio.gather(
-        worker(),
+        *[worker() for _ in range(config.get_nowait('Worker', 'count', default=8))],
         irc.connect(),
         dc_bot.start(config.get_nowait('Discord', 'token')),
         tg.deleted_poller(),
+        db.flusher(),
+        utils.clock(),
+        utils.watch_config(),
         tg_bot.run_until_disconnected(),
     )
 
@@ -360,3 +554,6 @@ try:
     tg_bot.loop.run_until_complete(main())
 except KeyboardInterrupt:
     exit(0)
+finally:
+    # Write out remaining log records
+    log_listener.stop()
@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+from bot.config import Config
+
+class ReloadTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.yaml')
+        with os.fdopen(fd, 'w') as f:
+            f.write('Bridge:\n- [irc/#a, telegram/-1001]\n')
+        self.config = Config(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write(self, content: str):
+        with open(self.path, 'w') as f:
+            f.write(content)
+        # Make sure the modification time changes even on filesystems with coarse timestamps
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+    async def test_reload_modified_file(self):
+        await self.config.load()
+        self.assertFalse(await self.config.reload_if_changed())
+        self.write('Bridge:\n- [irc/#b, telegram/-1002]\n')
+        self.assertTrue(await self.config.reload_if_changed())
+        self.assertEqual(await self.config.get('Bridge'), [['irc/#b', 'telegram/-1002']])
+
+    async def test_keep_config_on_malformed_file(self):
+        await self.config.load()
+        self.write('Bridge:\n- [irc/#b, telegram/-1002\n')
+        with self.assertLogs('bot.config', level='WARNING'):
+            self.assertFalse(await self.config.reload_if_changed())
+        self.assertEqual(await self.config.get('Bridge'), [['irc/#a', 'telegram/-1001']])
+        # Not retried until the file is modified again
+        self.assertFalse(await self.config.reload_if_changed())
+        self.write('Bridge:\n- [irc/#b, telegram/-1002]\n')
+        self.assertTrue(await self.config.reload_if_changed())
+        self.assertEqual(await self.config.get('Bridge'), [['irc/#b', 'telegram/-1002']])
+
+    async def test_keep_config_on_empty_file(self):
+        await self.config.load()
+        # e.g. the file is read while being written
+        self.write('')
+        with self.assertLogs('bot.config', level='WARNING'):
+            self.assertFalse(await self.config.reload_if_changed())
+        self.assertEqual(await self.config.get('Bridge'), [['irc/#a', 'telegram/-1001']])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# Modules read bridge.yaml in the working directory on import, so give them the example config
+config_dir = tempfile.TemporaryDirectory()
+shutil.copy(os.path.join(ROOT, 'bridge-example.yaml'), os.path.join(config_dir.name, 'bridge.yaml'))
+cwd = os.getcwd()
+os.chdir(config_dir.name)
+try:
+    from bot.config import Config
+    from bot.filter import Filter, compile_pattern, pattern_platforms
+    from bot.message import Message
+    from bot.utils import PLATFORMS
+finally:
+    os.chdir(cwd)
+
+class CompilePatternTest(unittest.TestCase):
+    def test_literal_pattern(self):
+        self.assertTrue(compile_pattern('bad')('badguy'))
+        self.assertTrue(compile_pattern('telegram')('telegram/-100123456789'))
+        self.assertFalse(compile_pattern('badguy')('bad'))
+
+    def test_empty_pattern(self):
+        self.assertTrue(compile_pattern('')('irc/#channel'))
+
+    def test_regex_pattern(self):
+        self.assertTrue(compile_pattern(r'^\(NOFWD\)')('(NOFWD) hello'))
+        self.assertFalse(compile_pattern(r'^\(NOFWD\)')('hello (NOFWD)'))
+
+class PatternPlatformsTest(unittest.TestCase):
+    def test_anchored_prefix(self):
+        self.assertEqual(pattern_platforms('^telegram'), ('telegram',))
+        self.assertEqual(pattern_platforms('^telegram/'), ('telegram',))
+        self.assertEqual(pattern_platforms('^telegram/-100123456789'), ('telegram',))
+        self.assertEqual(pattern_platforms(r'^discord\/123'), ('discord',))
+        self.assertEqual(pattern_platforms('^i'), ('irc',))
+        self.assertEqual(pattern_platforms('^irc/#channel'), ('irc',))
+
+    def test_anchored_prefix_of_no_platform(self):
+        self.assertEqual(pattern_platforms('^telegramx'), ())
+        self.assertEqual(pattern_platforms('^slack/'), ())
+
+    def test_unanchored(self):
+        self.assertEqual(pattern_platforms(''), PLATFORMS)
+        self.assertEqual(pattern_platforms('telegram'), PLATFORMS)
+        self.assertEqual(pattern_platforms('(?i)^telegram'), PLATFORMS)
+
+    def test_alternation(self):
+        self.assertEqual(pattern_platforms('^telegram|irc'), PLATFORMS)
+        self.assertEqual(pattern_platforms('^irc/(#a|#b)'), PLATFORMS)
+
+    def test_quantifier(self):
+        self.assertEqual(pattern_platforms('^ircx?'), PLATFORMS)
+        self.assertEqual(pattern_platforms('^telegramx*'), PLATFORMS)
+        self.assertEqual(pattern_platforms('^telegram+'), PLATFORMS)
+        self.assertEqual(pattern_platforms('^discordx{0,1}'), PLATFORMS)
+
+    def test_no_literal(self):
+        self.assertEqual(pattern_platforms('^.'), PLATFORMS)
+        self.assertEqual(pattern_platforms('^[ti]'), PLATFORMS)
+
+class FilterTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.yaml')
+        with os.fdopen(fd, 'w') as f:
+            yaml.dump({'filters': [
+                # No group, matches messages from any group
+                {'event': 'send', 'text': r'^\(NOFWD\)'},
+                # Plain literal patterns
+                {'event': 'receive', 'group': 'telegram', 'nick': 'spammer'},
+                # Anchored group pattern, only for IRC channels
+                {'event': 'send', 'group': '^irc/', 'text': 'irc only'},
+                # Invalid event, never matches
+                {'event': 'edit', 'text': 'hello'},
+            ]}, f)
+        self.filter = Filter()
+        self.filter.config = Config(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def message(self, from_group: str, text: str, from_nick: str='someone') -> Message:
+        message = Message()
+        message.from_group = from_group
+        message.text = text
+        message.from_nick = from_nick
+        return message
+
+    async def test_filter_without_group(self):
+        self.assertTrue(await self.filter.test(self.message('irc/#channel', '(NOFWD) hello'), 'telegram/-100123456789'))
+        self.assertFalse(await self.filter.test(self.message('irc/#channel', 'hello'), 'telegram/-100123456789'))
+
+    async def test_filter_with_literal_patterns(self):
+        self.assertTrue(await self.filter.test(self.message('irc/#channel', 'hello', 'spammer_'), 'telegram/-100123456789'))
+        self.assertFalse(await self.filter.test(self.message('irc/#channel', 'hello', 'spammer_'), 'discord/123456789'))
+        self.assertFalse(await self.filter.test(self.message('irc/#channel', 'hello', 'user'), 'telegram/-100123456789'))
+
+    async def test_filter_with_anchored_group(self):
+        self.assertTrue(await self.filter.test(self.message('irc/#channel', 'irc only'), 'telegram/-100123456789'))
+        self.assertFalse(await self.filter.test(self.message('telegram/-100123456789', 'irc only'), 'irc/#channel'))
+
+    async def test_unanchored_group_matches_anywhere(self):
+        # The group pattern 'telegram' is found in irc/#telegram as well
+        self.assertTrue(await self.filter.test(self.message('telegram/-100123456789', 'hello', 'spammer'), 'irc/#telegram'))
+
+    async def test_index(self):
+        await self.filter.test(self.message('irc/#channel', 'hello'), 'telegram/-100123456789')
+        filters = await self.filter.config.get('filters')
+        for platform in PLATFORMS:
+            # Filters without a group or with an unanchored group are checked for every platform
+            self.assertIn(filters[0], self.filter._index[('send', platform)])
+            self.assertIn(filters[1], self.filter._index[('receive', platform)])
+            # Invalid events are left out
+            self.assertNotIn(filters[3], self.filter._index[('send', platform)])
+        self.assertIn(filters[2], self.filter._index[('send', 'irc')])
+        self.assertNotIn(filters[2], self.filter._index[('send', 'telegram')])
+        self.assertNotIn(filters[2], self.filter._index[('send', 'discord')])
+
+if __name__ == '__main__':
+    unittest.main()